@@ -1,156 +1,774 @@
+import atexit
 import os
 import logging
+import multiprocessing
+import queue
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
 from pdf2image import convert_from_path, pdfinfo_from_path
 from pdf2image.exceptions import (
     PDFInfoNotInstalledError,
     PDFPageCountError,
     PDFSyntaxError
 )
+import numpy as np
 from PIL import Image, UnidentifiedImageError
-import shutil # For testing block cleanup
+import shutil
+
+from core import page_cache
+
+# PyMuPDF (fitz) рендерит PDF без внешних процессов poppler. Если не установлен -
+# используется pdf2image (pdfinfo + pdftoppm)
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz # Старые версии PyMuPDF (< 1.24)
+    except ImportError:
+        fitz = None
 
 logger = logging.getLogger(__name__)
 
-SUPPORTED_IMAGE_EXT = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
-SUPPORTED_PDF_EXT = {'.pdf'}
+SUPPORTED_IMAGE_EXT = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'})
+SUPPORTED_PDF_EXT = frozenset({'.pdf'})
+# Границы длины расширения (с точкой): файлы с расширением другой длины
+# (.c, .py, .json, .html и т.п.) отсеиваются без среза и lower()
+_EXT_LEN_MIN = min(map(len, SUPPORTED_IMAGE_EXT | SUPPORTED_PDF_EXT))
+_EXT_LEN_MAX = max(map(len, SUPPORTED_IMAGE_EXT | SUPPORTED_PDF_EXT))
 
-def iterate_document_items(input_dir_abs: str, config: dict):
+# Открытый документ PyMuPDF в процессе-воркере: соседние страницы одного PDF
+# обычно попадают в один воркер, и повторно разбирать файл не нужно
+_worker_pdf_path = None
+_worker_pdf_doc = None
+
+# Параметры JPEG для временных файлов страниц poppler (без optimize - он только замедляет запись)
+_POPPLER_JPEG_OPTIONS = {'quality': 90, 'progressive': False, 'optimize': False}
+
+# Служебные директории, в которые обход не заходит (переопределяется skip_dirs в конфиге)
+DEFAULT_SKIP_DIRS = ('.git', '.svn', '.hg', '__pycache__', 'node_modules', '.venv', 'venv', '.idea')
+
+# LRU-кэш количества страниц PDF: путь -> (mtime_ns, количество страниц)
+_PAGE_COUNT_CACHE_SIZE = 1024
+_page_count_cache = OrderedDict()
+
+
+def _scan_tree(input_dir_abs: str, skip_dirs: frozenset = frozenset(), skip_hidden: bool = False):
     """
-    Генератор, обходящий input_dir_abs, находящий поддерживаемые файлы
-    (изображения и PDF) и возвращающий (yields) для каждой страницы/изображения
-    кортеж (metadata, pil_image). Обрабатывает PDF постранично.
+    Рекурсивно обходит директорию через os.scandir (стек вместо рекурсии)
+    и возвращает (yields) кортежи (DirEntry, relative_path) для файлов.
+
+    Порядок обхода совпадает с os.walk (top-down): сначала файлы директории,
+    затем поддиректории в порядке листинга. Символические ссылки на директории
+    не разворачиваются (как и в os.walk по умолчанию), что исключает циклы.
+    Тип записи берется из кэша DirEntry (d_type), без лишних stat.
+    Директории из skip_dirs (и скрытые, при skip_hidden=True) не читаются вовсе.
+
+    Ошибка чтения корневой директории пробрасывается вызывающему коду,
+    ошибки чтения вложенных директорий логируются, директория пропускается.
+    """
+    # Стек пар (абсолютный путь, относительный путь от input_dir_abs)
+    stack = [(input_dir_abs, '')]
+    while stack:
+        dir_abs, rel_parent = stack.pop()
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dir_abs) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        name = entry.name
+                        if name in skip_dirs or (skip_hidden and name.startswith('.')):
+                            continue
+                        subdirs.append(entry)
+                    elif entry.is_file():
+                        files.append(entry)
+        except OSError as e:
+            if not rel_parent:
+                raise
+            logger.warning(f"Не удалось прочитать директорию '{dir_abs}': {e}. Пропущена.")
+            continue
+
+        # Директория прочитана целиком и закрыта до того, как мы начнем отдавать файлы
+        prefix = rel_parent + os.sep if rel_parent else ''
+        for entry in files:
+            yield entry, prefix + entry.name
+
+        # В обратном порядке, чтобы первой из стека извлекалась первая поддиректория
+        for entry in reversed(subdirs):
+            stack.append((entry.path, prefix + entry.name))
 
-    Args:
-        input_dir_abs (str): Абсолютный путь к директории с входными файлами.
-        config (dict): Словарь конфигурации.
+
+def _scan_supported_files(input_dir_abs: str, skip_dirs: frozenset = frozenset(), skip_hidden: bool = False):
+    """
+    Обертка над _scan_tree: отбирает только поддерживаемые файлы
+    и сразу определяет для них обработчик по расширению (_EXT_DISPATCH).
 
     Yields:
-        tuple: Кортеж вида (dict, PIL.Image.Image), где dict - метаданные,
-               а PIL.Image.Image - изображение. Либо (None, None) при ошибке.
+        tuple: (DirEntry, relative_path, handler).
     """
-    pdf_dpi = config.get('pdf_dpi', 300)
-    # Получаем только имя базовой входной директории для метаданных
-    input_dir_base_name = os.path.basename(input_dir_abs.rstrip('/\\')) # Удаляем слэш в конце, если есть
+    for entry, relative_path in _scan_tree(input_dir_abs, skip_dirs, skip_hidden):
+        # Расширение без os.path.splitext: всё начиная с последней точки
+        name = entry.name
+        dot = name.rfind('.')
+        if dot < 0 or not _EXT_LEN_MIN <= len(name) - dot <= _EXT_LEN_MAX:
+            continue
+        handler = _EXT_DISPATCH.get(name[dot:].lower())
+        if handler is not None:
+            yield entry, relative_path, handler
+        # Логирование пропущенных файлов отключено, чтобы избежать спама
 
-    logger.info(f"Сканирование директории: {input_dir_abs}")
-    logger.debug(f"Имя базовой директории для метаданных: '{input_dir_base_name}'")
-    logger.debug(f"Поддерживаемые форматы изображений: {SUPPORTED_IMAGE_EXT}")
-    logger.debug(f"Поддерживаемые форматы документов: {SUPPORTED_PDF_EXT}")
-    logger.debug(f"DPI для конвертации PDF: {pdf_dpi}")
 
+def _readahead(file_path: str):
+    """
+    Просит ядро асинхронно подгрузить файл в page cache (posix_fadvise WILLNEED).
+    Вызов не блокируется на чтении; на платформах без posix_fadvise ничего не делает.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # Это только подсказка ядру, ошибки не важны
+
+
+def _with_readahead(items):
+    """
+    Пропускает элементы (DirEntry, ...) без изменений, но перед выдачей файла K
+    запускает упреждающее чтение файла K+1: его чтение с диска идет,
+    пока вызывающий код обрабатывает файл K.
+    """
+    it = iter(items)
+    current = next(it, None)
+    while current is not None:
+        upcoming = next(it, None)
+        if upcoming is not None:
+            _readahead(upcoming[0].path)
+        yield current
+        current = upcoming
+
+
+def _make_metadata(entry, relative_path: str, input_dir_base_name: str, source_type: str, page_num: int) -> dict:
+    """Формирует словарь метаданных элемента (изображения или страницы PDF)."""
+    return {
+        'input_directory': input_dir_base_name, # Базовая папка
+        'relative_path': relative_path,        # Путь отн. базовой
+        'original_filename': entry.name,       # Имя файла
+        'source_path': entry.path,             # Полный путь (для логов/отладки)
+        'source_type': source_type,            # Тип источника: 'image' или 'pdf_page'
+        'page_num': page_num                   # Для изображений условно 1
+    }
+
+
+def _read_file_bytes(file_path: str) -> bytes:
+    """Читает файл целиком (режим yield_mode: 'encoded' для изображений)."""
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def _png_for_yield(png_bytes: bytes, metadata: dict, options: dict):
+    """
+    Приводит закодированную в PNG страницу к виду, заданному yield_mode:
+    'encoded' - сами байты, 'path' - путь к временному PNG-файлу в options['page_dir']
+    (в метаданных отмечается 'temp_file': True, удаляет файл вызывающий код).
+    """
+    if options['yield_mode'] == 'encoded':
+        return png_bytes
+    fd, page_path = tempfile.mkstemp(prefix='page_', suffix='.png', dir=options['page_dir'])
+    with os.fdopen(fd, 'wb') as f:
+        f.write(png_bytes)
+    metadata['temp_file'] = True
+    return page_path
+
+
+def _page_for_yield(page_img, metadata: dict, options: dict):
+    """Приводит отрендеренную страницу (PIL.Image или np.ndarray) к виду, заданному yield_mode."""
+    if options['yield_mode'] == 'image':
+        if isinstance(page_img, np.ndarray):
+            # Форма и тип сразу в метаданных, чтобы не инспектировать массив повторно
+            metadata['shape'] = page_img.shape
+            metadata['dtype'] = str(page_img.dtype)
+        return page_img
+    if isinstance(page_img, np.ndarray):
+        page_img = Image.fromarray(page_img)
+    return _png_for_yield(_encode_png(page_img), metadata, options)
+
+
+def _handle_image(entry, relative_path: str, options: dict):
+    """
+    Обработчик файла изображения.
+
+    Yields:
+        tuple: (metadata, PIL.Image.Image) или (None, None) при ошибке.
+               При yield_mode 'path' / 'encoded' вместо изображения - путь к файлу
+               или его байты (без декодирования).
+    """
+    file_path = entry.path
+    st = entry.stat() # Закэширован в DirEntry после обхода, повторного syscall нет
+    logger.debug("Найдено изображение: '%s' (%d байт)", relative_path, st.st_size)
+    if st.st_size == 0:
+        logger.warning(f"Пустой файл изображения пропущен: {file_path}")
+        yield None, None
+        return
+    yield_mode = options['yield_mode']
+    if yield_mode != 'image':
+        metadata = _make_metadata(entry, relative_path, options['input_directory'], 'image', 1)
+        if yield_mode == 'path':
+            yield metadata, file_path
+            return
+        try:
+            file_bytes = _read_file_bytes(file_path)
+        except OSError as e:
+            logger.error(f"Ошибка при чтении изображения {file_path}: {e}")
+            yield None, None
+            return
+        yield metadata, file_bytes
+        return
+    try:
+        img = _open_image(file_path, options['max_long_edge_px'])
+    except UnidentifiedImageError:
+        logger.error(f"Не удалось распознать формат изображения: {file_path}")
+        yield None, None
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при чтении изображения {file_path}: {e}", exc_info=True)
+        yield None, None
+        return
+
+    # Отдаем само изображение без копии: после load() файл уже прочитан,
+    # владение (и закрытие) переходит к вызывающему коду
+    yield _make_metadata(entry, relative_path, options['input_directory'], 'image', 1), img
+
+
+def _handle_pdf(entry, relative_path: str, options: dict):
+    """
+    Обработчик PDF: рендерит и отдает страницы по одной.
+
+    Yields:
+        tuple: (metadata, PIL.Image.Image) для каждой страницы или (None, None) при ошибке.
+               При yield_mode 'path' / 'encoded' вместо изображения - путь к PNG-файлу
+               страницы или PNG-байты.
+    """
+    file_path = entry.path
+    st = entry.stat() # Один stat на файл: размер для проверки, mtime для кэшей
+    logger.debug("Найден PDF: '%s' (%d байт)", relative_path, st.st_size)
+    if st.st_size == 0:
+        logger.warning(f"Пустой PDF файл пропущен: {file_path}")
+        yield None, None
+        return
+    try:
+        if fitz is not None:
+            page_iter = _render_pdf_pages_fitz(file_path, relative_path, st.st_mtime_ns, options)
+        else:
+            page_iter = _render_pdf_pages_poppler(file_path, relative_path, st.st_mtime_ns, options)
+
+        for page_num, page_img in page_iter:
+            if page_img is None:
+                yield None, None # Сигнал об ошибке для этой страницы
+                continue
+            metadata = _make_metadata(entry, relative_path, options['input_directory'], 'pdf_page', page_num)
+            page_img = _page_for_yield(page_img, metadata, options)
+            # Возвращаем результат для текущей страницы НЕМЕДЛЕННО
+            yield metadata, page_img
+            # Очистка изображения будет происходить в вызывающем коде (main.py)
+
+    except (PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError) as info_err:
+        # Ошибка при получении ИНФОРМАЦИИ о файле (до цикла по страницам)
+        logger.error(f"Критическая ошибка при получении информации о PDF '{relative_path}': {info_err}. Файл пропущен.", exc_info=True)
+        yield None, None # Сигнал об ошибке для всего этого PDF
+    except FileNotFoundError:
+        logger.error(f"Файл не найден при обработке PDF: {file_path}")
+        yield None, None
+    except Exception as e:
+        # Любая другая ошибка на уровне файла PDF
+        logger.error(f"Непредвиденная ошибка при обработке PDF '{relative_path}': {e}", exc_info=True)
+        yield None, None
+
+
+# Диспетчер по расширению: один поиск в словаре на файл вместо проверок по двум множествам
+_EXT_DISPATCH = {
+    **dict.fromkeys(SUPPORTED_IMAGE_EXT, _handle_image),
+    **dict.fromkeys(SUPPORTED_PDF_EXT, _handle_pdf),
+}
+
+
+def _encode_png(page_img) -> bytes:
+    """Кодирует страницу (PIL.Image) в PNG с минимальным сжатием (для кэша и передачи между процессами)."""
+    buf = BytesIO()
+    page_img.save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
+
+def _decode_png(png_bytes: bytes, as_numpy: bool):
+    """Декодирует PNG-страницу в PIL.Image или, при as_numpy=True, в np.ndarray."""
+    page_img = Image.open(BytesIO(png_bytes))
+    page_img.load()
+    if as_numpy:
+        return np.asarray(page_img)
+    return page_img
+
+
+def _page_cache_lookup(options: dict, file_path: str, mtime_ns: int, page_num: int):
+    """Возвращает страницу из кэша (PIL.Image или np.ndarray) или None."""
+    cache_opts = options['page_cache']
+    if cache_opts is None:
+        return None
+    png_bytes = page_cache.get(cache_opts['dir'], file_path, mtime_ns, page_num, options['pdf_dpi'],
+                               options['max_long_edge_px'])
+    if png_bytes is None:
+        return None
+    logger.debug("Страница %d файла '%s' взята из кэша.", page_num, file_path)
+    return _decode_png(png_bytes, options['pdf_page_format'] == 'numpy')
+
+
+def _page_cache_store(options: dict, file_path: str, mtime_ns: int, page_num: int, png_bytes: bytes):
+    """Сохраняет отрендеренную страницу (PNG) в кэш, если кэш включен."""
+    cache_opts = options['page_cache']
+    if cache_opts is not None:
+        page_cache.put(cache_opts['dir'], file_path, mtime_ns, page_num, options['pdf_dpi'], png_bytes,
+                       cache_opts['max_bytes'], options['max_long_edge_px'])
+
+
+def _pdf_info(file_path: str, mtime_ns: int) -> tuple:
+    """
+    Возвращает (количество страниц, размер первой страницы в пунктах или None).
+    Размер известен только при работе через pdfinfo (poppler); с PyMuPDF
+    размер берется у каждой страницы при рендеринге.
+    Результат кэшируется по пути и mtime файла (mtime_ns берется из уже
+    полученного stat), поэтому повторный обход не разбирает PDF заново.
+    """
+    cached = _page_count_cache.get(file_path)
+    if cached is not None and cached[0] == mtime_ns:
+        _page_count_cache.move_to_end(file_path)
+        return cached[1], cached[2]
+
+    page_size = None
+    if fitz is not None:
+        with fitz.open(file_path) as doc:
+            total_pages = doc.page_count
+    else:
+        info = pdfinfo_from_path(file_path, userpw=None, poppler_path=None)
+        total_pages = info.get("Pages", 0)
+        # Формат pdfinfo: "595.276 x 841.89 pts (A4)"
+        size_parts = str(info.get("Page size", "")).split()
+        if len(size_parts) >= 3 and size_parts[1] == 'x':
+            try:
+                page_size = (float(size_parts[0]), float(size_parts[2]))
+            except ValueError:
+                page_size = None
+
+    _page_count_cache[file_path] = (mtime_ns, total_pages, page_size)
+    if len(_page_count_cache) > _PAGE_COUNT_CACHE_SIZE:
+        _page_count_cache.popitem(last=False)
+    return total_pages, page_size
+
+
+def _pdf_page_count(file_path: str, mtime_ns: int) -> int:
+    """Возвращает количество страниц PDF (PyMuPDF или pdfinfo), см. _pdf_info."""
+    return _pdf_info(file_path, mtime_ns)[0]
+
+
+def _effective_dpi(pdf_dpi: int, width_pt: float, height_pt: float, max_long_edge_px: int) -> int:
+    """
+    Понижает DPI для крупных страниц так, чтобы длинная сторона страницы не
+    превышала max_long_edge_px пикселей (размеры страницы - в пунктах, 1/72 дюйма).
+    Для обычных страниц возвращает pdf_dpi без изменений.
+    """
+    long_edge_pt = max(width_pt, height_pt)
+    if not max_long_edge_px or long_edge_pt <= 0:
+        return pdf_dpi
+    return max(1, min(pdf_dpi, int(max_long_edge_px * 72 / long_edge_pt)))
+
+
+class _PixmapArray:
+    """
+    Обертка pixmap PyMuPDF для np.asarray без копирования: массив получает
+    эту обертку как base и тем самым удерживает pixmap (и его память) живым.
+    """
+    __slots__ = ('pix', '__array_interface__')
+
+    def __init__(self, pix):
+        self.pix = pix
+        self.__array_interface__ = {
+            'version': 3,
+            'shape': (pix.height, pix.width, pix.n),
+            'typestr': '|u1',
+            'strides': (pix.stride, pix.n, 1),
+            'data': (pix.samples_ptr, False),
+        }
+
+
+def _pixmap_to_array(pix) -> np.ndarray:
+    """Возвращает np.ndarray (H, W, n) uint8, разделяющий память с pixmap (без memcpy страницы)."""
+    return np.asarray(_PixmapArray(pix))
+
+
+def _render_pdf_pages_fitz(file_path: str, relative_path: str, mtime_ns: int, options: dict):
+    """
+    Рендерит страницы PDF через PyMuPDF. Документ открывается и разбирается
+    один раз, страницы отдаются по одной (потоково). Если включен кэш страниц,
+    уже отрендеренные ранее страницы берутся из него.
+
+    Yields:
+        tuple: (page_num, PIL.Image.Image) или (page_num, None) при ошибке страницы.
+               При as_numpy=True вместо PIL.Image - np.ndarray (H, W, 3) uint8, RGB.
+    """
+    pdf_dpi = options['pdf_dpi']
+    as_numpy = options['pdf_page_format'] == 'numpy'
+    cache_mtime_ns = mtime_ns if options['page_cache'] is not None else None
+
+    doc = fitz.open(file_path)
+    try:
+        total_pages = doc.page_count
+        if total_pages <= 0:
+            logger.warning(f"PDF файл '{relative_path}' не содержит страниц или не удалось определить их количество.")
+            return
+
+        logger.info("Обработка PDF: '%s' (Всего страниц: %d)", relative_path, total_pages)
+
+        for page_index in range(total_pages):
+            page_num = page_index + 1
+            logger.info("Конвертация страницы %d из %d файла '%s'...", page_num, total_pages, relative_path)
+            try:
+                page_img = _page_cache_lookup(options, file_path, cache_mtime_ns, page_num)
+                if page_img is not None:
+                    yield page_num, page_img
+                    continue
+                page = doc.load_page(page_index)
+                page_dpi = _effective_dpi(pdf_dpi, page.rect.width, page.rect.height, options['max_long_edge_px'])
+                if page_dpi != pdf_dpi:
+                    logger.debug("Страница %d файла '%s' слишком крупная: рендеринг с DPI %d вместо %d.",
+                                 page_num, relative_path, page_dpi, pdf_dpi)
+                pix = page.get_pixmap(dpi=page_dpi, alpha=False)
+                # Массив и PIL.Image ссылаются на память pixmap без копирования;
+                # pixmap живет, пока жива страница
+                page_arr = _pixmap_to_array(pix)
+                pil_img = None
+                if not as_numpy or cache_mtime_ns is not None:
+                    pil_img = Image.frombuffer("RGB", (pix.width, pix.height), page_arr, "raw", "RGB", 0, 1)
+                if cache_mtime_ns is not None:
+                    # Тот же быстрый уровень сжатия, что и для страниц poppler (pix.tobytes("png")
+                    # сжимает сильнее и дольше, чем длится сам рендеринг)
+                    _page_cache_store(options, file_path, cache_mtime_ns, page_num, _encode_png(pil_img))
+                page_img = page_arr if as_numpy else pil_img
+                pix = pil_img = page_arr = None
+            except Exception as page_err:
+                # Ошибка при конвертации КОНКРЕТНОЙ страницы
+                logger.error(f"Ошибка при конвертации страницы {page_num} файла '{relative_path}': {page_err}", exc_info=True)
+                yield page_num, None
+                continue
+            yield page_num, page_img
+    finally:
+        doc.close()
+
+
+def _render_pdf_pages_poppler(file_path: str, relative_path: str, mtime_ns: int, options: dict):
+    """
+    Рендерит страницы PDF через pdf2image (poppler). Используется, если PyMuPDF недоступен.
+    Страницы конвертируются пачками по pdf_page_batch за один вызов pdftoppm
+    (разбор PDF один раз на пачку), но отдаются по одной. Временные файлы
+    страниц пишутся в формате pdf_temp_format ('jpeg', 'png' или 'ppm').
+    Пачка, все страницы которой есть в кэше страниц, не конвертируется.
+
+    Yields:
+        tuple: (page_num, PIL.Image.Image) или (page_num, None) при ошибке страницы.
+               При as_numpy=True вместо PIL.Image - np.ndarray (H, W, 3) uint8, RGB.
+    """
+    pdf_dpi = options['pdf_dpi']
+    as_numpy = options['pdf_page_format'] == 'numpy'
+    page_batch = options['pdf_page_batch']
+    temp_format = options['pdf_temp_format']
+    cache_mtime_ns = mtime_ns if options['page_cache'] is not None else None
+
+    # 1. Получаем общее количество страниц и размер страницы (pdfinfo, один раз на файл)
+    total_pages, page_size = _pdf_info(file_path, mtime_ns)
+    if page_size is not None:
+        # pdfinfo сообщает размер первой страницы - DPI выбирается на весь документ
+        pdf_dpi = _effective_dpi(pdf_dpi, page_size[0], page_size[1], options['max_long_edge_px'])
+        if pdf_dpi != options['pdf_dpi']:
+            logger.debug("Страницы PDF '%s' слишком крупные: рендеринг с DPI %d вместо %d.",
+                         relative_path, pdf_dpi, options['pdf_dpi'])
+    if total_pages <= 0:
+        logger.warning(f"PDF файл '{relative_path}' не содержит страниц или не удалось определить их количество.")
+        return
+
+    logger.info("Обработка PDF: '%s' (Всего страниц: %d)", relative_path, total_pages)
+
+    # Каждому PDF - своя временная директория: poppler пишет страницы на диск,
+    # а не держит их все в памяти, и только с output_folder thread_count дает эффект
+    with tempfile.TemporaryDirectory(prefix='ocrpipe_') as tmp_dir:
+        # 2. Цикл по пачкам страниц
+        for first_page in range(1, total_pages + 1, page_batch):
+            last_page = min(first_page + page_batch - 1, total_pages)
+            if cache_mtime_ns is not None:
+                cached_pages = [_page_cache_lookup(options, file_path, cache_mtime_ns, page_num)
+                                for page_num in range(first_page, last_page + 1)]
+                if all(page_img is not None for page_img in cached_pages):
+                    for offset, page_img in enumerate(cached_pages):
+                        yield first_page + offset, page_img
+                    continue
+                cached_pages = None
+            logger.info("Конвертация страниц %d-%d из %d файла '%s'...", first_page, last_page, total_pages, relative_path)
+            try:
+                # 3. Конвертируем пачку страниц одним вызовом (изображения открываются из файлов лениво)
+                images = convert_from_path(
+                    file_path,
+                    dpi=pdf_dpi,
+                    poppler_path=None,
+                    first_page=first_page,
+                    last_page=last_page,
+                    thread_count=options['pdf_thread_count'],
+                    output_folder=tmp_dir,
+                    fmt=temp_format,
+                    jpegopt=_POPPLER_JPEG_OPTIONS if temp_format == 'jpeg' else None
+                )
+            except Exception as batch_err:
+                logger.error(f"Ошибка при конвертации страниц {first_page}-{last_page} файла '{relative_path}': {batch_err}", exc_info=True)
+                for page_num in range(first_page, last_page + 1):
+                    yield page_num, None
+                continue
+
+            if len(images) != last_page - first_page + 1:
+                logger.warning(f"Из '{relative_path}' для страниц {first_page}-{last_page} получено изображений: {len(images)}.")
+
+            # 4. Отдаем страницы пачки по одной
+            try:
+                for page_num, page_img in _yield_loaded_pages(images, first_page, last_page, relative_path, as_numpy):
+                    if page_img is not None and cache_mtime_ns is not None:
+                        png_source = Image.fromarray(page_img) if as_numpy else page_img
+                        _page_cache_store(options, file_path, cache_mtime_ns, page_num, _encode_png(png_source))
+                    yield page_num, page_img
+            finally:
+                # Если потребитель остановился на середине пачки - закрываем файлы оставшихся страниц
+                for page_img in images:
+                    if page_img is not None:
+                        page_img.close()
+
+
+def _yield_loaded_pages(images: list, first_page: int, last_page: int, relative_path: str, as_numpy: bool):
+    """
+    Загружает в память и отдает по одной страницы пачки, полученной от pdf2image.
+    Отданные страницы удаляются из списка images (ссылкой владеет вызывающий код).
+    """
+    for page_num in range(first_page, last_page + 1):
+        offset = page_num - first_page
+        page_img = images[offset] if offset < len(images) else None
+        if page_img is None:
+            yield page_num, None
+            continue
+        images[offset] = None # Не держим ссылку на уже отданную страницу
+        try:
+            # Изображение открыто лениво из файла во временной директории -
+            # загружаем его в память и сразу удаляем файл страницы с диска
+            page_img.load()
+            os.remove(page_img.filename)
+            if as_numpy:
+                page_array = np.asarray(page_img.convert('RGB'))
+                page_img.close()
+                page_img = page_array
+        except Exception as page_err:
+            # Ошибка при загрузке КОНКРЕТНОЙ страницы
+            logger.error(f"Ошибка при конвертации страницы {page_num} файла '{relative_path}': {page_err}", exc_info=True)
+            page_img = None
+
+        yield page_num, page_img
+
+
+def render_pdf_page(file_path: str, page_num: int, pdf_dpi: int, max_long_edge_px: int = 0) -> bytes:
+    """
+    Рендерит одну страницу PDF и возвращает ее в виде PNG.
+    Предназначена для запуска в процессе-воркере ProcessPoolExecutor:
+    PNG-байты передаются между процессами дешевле, чем PIL-изображение.
+
+    Args:
+        file_path (str): Путь к PDF.
+        page_num (int): Номер страницы (с 1).
+        pdf_dpi (int): Разрешение рендеринга.
+        max_long_edge_px (int): Для крупных страниц DPI понижается так, чтобы длинная
+            сторона не превышала этого числа пикселей (0 - без ограничения).
+
+    Returns:
+        bytes: Страница в формате PNG.
+    """
+    global _worker_pdf_path, _worker_pdf_doc
+
+    if fitz is not None:
+        if _worker_pdf_path != file_path:
+            if _worker_pdf_doc is not None:
+                _worker_pdf_doc.close()
+            _worker_pdf_doc = fitz.open(file_path)
+            _worker_pdf_path = file_path
+        page = _worker_pdf_doc.load_page(page_num - 1)
+        page_dpi = _effective_dpi(pdf_dpi, page.rect.width, page.rect.height, max_long_edge_px)
+        pix = page.get_pixmap(dpi=page_dpi, alpha=False)
+        page_img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        pix = None
+    else:
+        page_size = _pdf_info(file_path, os.stat(file_path).st_mtime_ns)[1]
+        if page_size is not None:
+            pdf_dpi = _effective_dpi(pdf_dpi, page_size[0], page_size[1], max_long_edge_px)
+        images = convert_from_path(file_path, dpi=pdf_dpi, poppler_path=None,
+                                   first_page=page_num, last_page=page_num)
+        if not images:
+            raise ValueError(f"Не удалось конвертировать страницу {page_num} (получен пустой список).")
+        page_img = images[0]
+
+    # Минимальное сжатие: PNG здесь только транспорт между процессами
+    return _encode_png(page_img)
+
+
+def _open_image(file_path: str, max_long_edge_px: int = 0) -> Image.Image:
+    """
+    Открывает и декодирует файл изображения (используется и в ThreadPoolExecutor).
+    Крупные JPEG декодируются через draft-режим libjpeg сразу в уменьшенном
+    масштабе (1/2, 1/4, 1/8), так что длинная сторона остается не меньше
+    max_long_edge_px - полный размер без нужды не декодируется.
+    """
+    img = Image.open(file_path)
+    if max_long_edge_px and img.format == 'JPEG':
+        width, height = img.size
+        long_edge = max(width, height)
+        if long_edge > max_long_edge_px:
+            ratio = max_long_edge_px / long_edge
+            img.draft(None, (max(1, int(width * ratio)), max(1, int(height * ratio))))
+    img.load() # Загружаем данные изображения
+    return img
+
+
+def load_item_image(item):
+    """
+    Декодирует элемент, отданный в режиме yield_mode 'path' или 'encoded'
+    (путь к файлу или байты), в PIL.Image. Изображения и массивы возвращает как есть.
+    """
+    if isinstance(item, (str, bytes)):
+        img = Image.open(item if isinstance(item, str) else BytesIO(item))
+        img.load()
+        return img
+    return item
+
+
+def _completed_future(result) -> Future:
+    """Future с готовым результатом (элемент, не требующий работы пула)."""
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _iterate_items_parallel(input_dir_abs: str, file_iter, options: dict, workers: int):
+    """
+    Параллельный вариант iterate_document_items: страницы PDF рендерятся
+    в пуле процессов (в том числе страницы разных PDF одновременно),
+    изображения декодируются в пуле потоков. Порядок элементов сохраняется,
+    в работе одновременно не более 2 * workers элементов.
+    """
+    input_dir_base_name = options['input_directory']
+    pdf_dpi = options['pdf_dpi']
+    as_numpy = options['pdf_page_format'] == 'numpy'
+    yield_mode = options['yield_mode']
     found_files_count = 0
     processed_items_count = 0
+    max_inflight = 2 * workers
+    inflight = deque() # (metadata, future, mtime_ns для записи в кэш или None) в порядке обхода
 
+    def collect(metadata, future, cache_mtime_ns):
+        nonlocal processed_items_count
+        try:
+            result = future.result()
+        except UnidentifiedImageError:
+            logger.error(f"Не удалось распознать формат изображения: {metadata['source_path']}")
+            return None, None
+        except Exception as e:
+            logger.error(f"Ошибка при получении элемента '{metadata['relative_path']}' "
+                         f"(страница {metadata['page_num']}): {e}", exc_info=True)
+            return None, None
+        if metadata['source_type'] == 'image':
+            # Изображения: PIL.Image, либо путь/байты файла в режимах 'path'/'encoded'
+            pass
+        elif isinstance(result, bytes):
+            # PNG-байты страницы из процесса-воркера
+            if cache_mtime_ns is not None:
+                _page_cache_store(options, metadata['source_path'], cache_mtime_ns, metadata['page_num'], result)
+            if yield_mode == 'image':
+                result = _page_for_yield(_decode_png(result, as_numpy), metadata, options)
+            else:
+                result = _png_for_yield(result, metadata, options)
+        else:
+            # Страница из кэша страниц (уже декодирована)
+            result = _page_for_yield(result, metadata, options)
+        processed_items_count += 1
+        return metadata, result
+
+    logger.info(f"Параллельная обработка: {workers} процессов для PDF.")
     try:
-        # Рекурсивный обход, если нужны файлы в поддиректориях
-        for root, _, files in os.walk(input_dir_abs):
-            for item_name in files:
-                file_path = os.path.join(root, item_name)
-                _, file_extension = os.path.splitext(item_name.lower())
-
-                # Вычисляем относительный путь от input_dir_abs
-                try:
-                    relative_path = os.path.relpath(file_path, start=input_dir_abs)
-                except ValueError as e:
-                    # Может возникнуть, если пути на разных дисках (Windows)
-                    logger.error(f"Не удалось вычислить относительный путь для {file_path} от {input_dir_abs}: {e}")
-                    relative_path = item_name # В крайнем случае используем просто имя файла
-
-                # --- Обработка изображений ---
-                if file_extension in SUPPORTED_IMAGE_EXT:
-                    found_files_count += 1
-                    logger.debug(f"Найдено изображение: '{relative_path}'")
-                    try:
-                        img = Image.open(file_path)
-                        img.load() # Загружаем данные изображения
-                        metadata = {
-                            'input_directory': input_dir_base_name, # Базовая папка
-                            'relative_path': relative_path,        # Путь отн. базовой
-                            'original_filename': item_name,        # Имя файла
-                            'source_path': file_path,              # Полный путь (для логов/отладки)
-                            'source_type': 'image',                # Тип источника
-                            'page_num': 1                          # Условно 1 страница
-                        }
-                        processed_items_count += 1
-                        yield metadata, img.copy() # Возвращаем копию
-                        img.close() # Закрываем файл
-                    except UnidentifiedImageError:
-                        logger.error(f"Не удалось распознать формат изображения: {file_path}")
-                        yield None, None
-                    except Exception as e:
-                        logger.error(f"Ошибка при чтении изображения {file_path}: {e}", exc_info=True)
-                        yield None, None
+        # spawn: обход выполняется в фоновом потоке многопоточного процесса (лог, запись результатов),
+        # fork в таком процессе небезопасен
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pdf_pool, \
+             ThreadPoolExecutor(max_workers=workers) as image_pool:
+            for entry, relative_path, handler in file_iter:
+                file_path = entry.path
+                found_files_count += 1
+                st = entry.stat() # Один stat на файл (закэширован в DirEntry)
+                if st.st_size == 0:
+                    logger.warning(f"Пустой файл пропущен: {file_path}")
+                    while inflight:
+                        yield collect(*inflight.popleft())
+                    yield None, None
+                    continue
 
-                # --- Обработка PDF (ПОСТРАНИЧНО) ---
-                elif file_extension in SUPPORTED_PDF_EXT:
-                    found_files_count += 1
-                    logger.debug(f"Найден PDF: '{relative_path}'")
-                    total_pages = 0
+                if handler is _handle_image:
+                    logger.debug("Найдено изображение: '%s' (%d байт)", relative_path, st.st_size)
+                    if yield_mode == 'path':
+                        load_image = lambda: (_completed_future(file_path), None)
+                    elif yield_mode == 'encoded':
+                        load_image = lambda: (image_pool.submit(_read_file_bytes, file_path), None)
+                    else:
+                        load_image = lambda: (image_pool.submit(_open_image, file_path, options['max_long_edge_px']), None)
+                    jobs = [(_make_metadata(entry, relative_path, input_dir_base_name, 'image', 1), load_image)]
+                else:
+                    logger.debug("Найден PDF: '%s' (%d байт)", relative_path, st.st_size)
                     try:
-                        # 1. Получаем общее количество страниц
-                        # (указываем poppler_path=None, т.к. pdf2image обычно сам находит его в PATH)
-                        info = pdfinfo_from_path(file_path, userpw=None, poppler_path=None)
-                        total_pages = info.get("Pages", 0)
-                        if total_pages <= 0:
-                            logger.warning(f"PDF файл '{relative_path}' не содержит страниц или не удалось определить их количество.")
-                            continue # Пропускаем этот файл, нет смысла обрабатывать
-
-                        logger.info(f"Обработка PDF: '{relative_path}' (Всего страниц: {total_pages})")
-
-                        # 2. Цикл по страницам
-                        for page_num in range(1, total_pages + 1):
-                            logger.info(f"Конвертация страницы {page_num} из {total_pages} файла '{relative_path}'...")
-                            page_img = None # Для корректной очистки в finally
-                            try:
-                                # 3. Конвертируем ТОЛЬКО ОДНУ страницу
-                                images = convert_from_path(
-                                    file_path,
-                                    dpi=pdf_dpi,
-                                    poppler_path=None,
-                                    first_page=page_num,
-                                    last_page=page_num # Указываем первую и последнюю страницу как одну и ту же
-                                )
-
-                                if images:
-                                    page_img = images[0] # Получаем единственное изображение из списка
-                                    metadata = {
-                                        'input_directory': input_dir_base_name,
-                                        'relative_path': relative_path,
-                                        'original_filename': item_name,
-                                        'source_path': file_path,
-                                        'source_type': 'pdf_page',
-                                        'page_num': page_num
-                                    }
-                                    processed_items_count += 1
-                                    # 4. Возвращаем результат для текущей страницы НЕМЕДЛЕННО
-                                    yield metadata, page_img
-                                    # Очистка изображения будет происходить в вызывающем коде (main.py)
-                                else:
-                                    logger.warning(f"Не удалось конвертировать страницу {page_num} из '{relative_path}' (получен пустой список).")
-                                    yield None, None # Сигнал об ошибке для этой страницы
-
-                            except Exception as page_err:
-                                # Ошибка при конвертации КОНКРЕТНОЙ страницы
-                                logger.error(f"Ошибка при конвертации страницы {page_num} файла '{relative_path}': {page_err}", exc_info=True)
-                                # Сигнализируем об ошибке для этой конкретной страницы
-                                yield None, None
-
-                    except (PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError) as info_err:
-                        # Ошибка при получении ИНФОРМАЦИИ о файле (до цикла по страницам)
-                        logger.error(f"Критическая ошибка при получении информации о PDF '{relative_path}': {info_err}. Файл пропущен.", exc_info=True)
-                        yield None, None # Сигнал об ошибке для всего этого PDF
-                    except FileNotFoundError:
-                         logger.error(f"Файл не найден при обработке PDF: {file_path}")
-                         yield None, None
+                        total_pages = _pdf_page_count(file_path, st.st_mtime_ns)
                     except Exception as e:
-                         # Любая другая ошибка на уровне файла PDF
-                        logger.error(f"Непредвиденная ошибка при обработке PDF '{relative_path}': {e}", exc_info=True)
+                        logger.error(f"Критическая ошибка при получении информации о PDF '{relative_path}': {e}. Файл пропущен.", exc_info=True)
+                        # Перед сигналом об ошибке отдаем всё, что уже в работе, чтобы сохранить порядок
+                        while inflight:
+                            yield collect(*inflight.popleft())
                         yield None, None
+                        continue
+                    if total_pages <= 0:
+                        logger.warning(f"PDF файл '{relative_path}' не содержит страниц или не удалось определить их количество.")
+                        continue
+                    logger.info("Обработка PDF: '%s' (Всего страниц: %d)", relative_path, total_pages)
+                    mtime_ns = st.st_mtime_ns if options['page_cache'] is not None else None
+
+                    def submit_page(page_num, file_path=file_path, mtime_ns=mtime_ns):
+                        # Страница из кэша не отправляется в пул - сразу готовый Future
+                        if mtime_ns is not None:
+                            page_img = _page_cache_lookup(options, file_path, mtime_ns, page_num)
+                            if page_img is not None:
+                                return _completed_future(page_img), None
+                        return pdf_pool.submit(render_pdf_page, file_path, page_num, pdf_dpi,
+                                               options['max_long_edge_px']), mtime_ns
+
+                    jobs = [(_make_metadata(entry, relative_path, input_dir_base_name, 'pdf_page', page_num),
+                             lambda page_num=page_num: submit_page(page_num))
+                            for page_num in range(1, total_pages + 1)]
 
-                # --- Неподдерживаемые файлы ---
-                # Логирование пропущенных файлов отключено по умолчанию, чтобы избежать спама
-                # else:
-                #    logger.debug(f"Пропущен неподдерживаемый файл: {relative_path}")
+                # Отправляем задачи по мере освобождения окна, чтобы не держать в памяти лишние страницы
+                for metadata, submit in jobs:
+                    while len(inflight) >= max_inflight:
+                        yield collect(*inflight.popleft())
+                    inflight.append((metadata, *submit()))
+
+            while inflight:
+                yield collect(*inflight.popleft())
 
     except FileNotFoundError:
         logger.error(f"Входная директория не найдена при сканировании: {input_dir_abs}")
@@ -160,6 +778,243 @@ def iterate_document_items(input_dir_abs: str, config: dict):
     logger.info(f"Сканирование завершено. Найдено поддерживаемых файлов: {found_files_count}. Обработано элементов (страниц/изображений): {processed_items_count}")
 
 
+def _iterate_items(input_dir_abs: str, config: dict):
+    """
+    Собственно обход и рендеринг (без фоновой предвыборки), см. iterate_document_items.
+    """
+    pdf_dpi = config.get('pdf_dpi', 300)
+    # Число потоков pdftoppm: по умолчанию все ядра, кроме одного
+    pdf_thread_count = config.get('pdf_thread_count') or max(1, (os.cpu_count() or 2) - 1)
+    # Получаем только имя базовой входной директории для метаданных
+    input_dir_base_name = os.path.basename(input_dir_abs.rstrip('/\\')) # Удаляем слэш в конце, если есть
+
+    logger.info(f"Сканирование директории: {input_dir_abs}")
+    logger.debug(f"Имя базовой директории для метаданных: '{input_dir_base_name}'")
+    logger.debug(f"Поддерживаемые форматы изображений: {SUPPORTED_IMAGE_EXT}")
+    logger.debug(f"Поддерживаемые форматы документов: {SUPPORTED_PDF_EXT}")
+    logger.debug(f"DPI для конвертации PDF: {pdf_dpi}")
+    logger.debug(f"Потоков для конвертации PDF: {pdf_thread_count}")
+    logger.debug(f"Движок рендеринга PDF: {'PyMuPDF' if fitz is not None else 'pdf2image (poppler)'}")
+
+    # Рекурсивный обход (включая поддиректории) на основе os.scandir
+    skip_dirs = config.get('skip_dirs')
+    skip_dirs = frozenset(DEFAULT_SKIP_DIRS if skip_dirs is None else skip_dirs)
+    skip_hidden = config.get('skip_hidden_dirs', True)
+    logger.debug(f"Пропускаемые директории: {sorted(skip_dirs)}{' и скрытые' if skip_hidden else ''}")
+    file_iter = _scan_supported_files(input_dir_abs, skip_dirs, skip_hidden)
+    if config.get('prefetch_files', True):
+        file_iter = _with_readahead(file_iter)
+
+    # Кэш отрендеренных страниц PDF (между запусками)
+    page_cache_config = config.get('page_cache') or {}
+    page_cache_opts = None
+    if page_cache_config.get('enabled', False):
+        page_cache_opts = {
+            'dir': page_cache_config.get('dir', '.page_cache'),
+            'max_bytes': int(page_cache_config.get('max_size_mb', 2048)) * 1024 * 1024,
+        }
+        logger.debug(f"Кэш страниц PDF: {page_cache_opts['dir']} (до {page_cache_opts['max_bytes']} байт)")
+
+    # Что отдавать вместо PIL.Image: путь к файлу / PNG-байты (для передачи в пул процессов)
+    yield_mode = config.get('yield_mode', 'image')
+    if yield_mode not in ('image', 'path', 'encoded'):
+        logger.warning(f"Неизвестный yield_mode '{yield_mode}', используется 'image'.")
+        yield_mode = 'image'
+    page_dir = None
+    own_page_dir = False # Директория страниц создана здесь (а не задана в page_output_dir)
+    if yield_mode == 'path':
+        page_dir = config.get('page_output_dir')
+        if not page_dir:
+            page_dir = tempfile.mkdtemp(prefix='ocrpipe_pages_')
+            own_page_dir = True
+            # Страницы, еще не обработанные к концу обхода (пул процессов) или оставшиеся после
+            # прерванного запуска, удаляются при завершении программы
+            atexit.register(shutil.rmtree, page_dir, ignore_errors=True)
+        os.makedirs(page_dir, exist_ok=True)
+        logger.info(f"Страницы PDF сохраняются во временные файлы в директории: {page_dir}")
+
+    options = {
+        'input_directory': input_dir_base_name,
+        'pdf_dpi': pdf_dpi,
+        'pdf_thread_count': pdf_thread_count,
+        'pdf_page_format': config.get('pdf_page_format', 'pil'),
+        'pdf_page_batch': max(1, config.get('pdf_page_batch') or 8),
+        'pdf_temp_format': config.get('pdf_temp_format', 'jpeg'),
+        'max_long_edge_px': config.get('max_long_edge_px', 3600) or 0,
+        'page_cache': page_cache_opts,
+        'yield_mode': yield_mode,
+        'page_dir': page_dir,
+    }
+
+    try:
+        # Пул процессов для рендеринга PDF (включается при pdf_render_workers > 1)
+        pdf_render_workers = config.get('pdf_render_workers') or 1
+        if pdf_render_workers > 1:
+            yield from _iterate_items_parallel(input_dir_abs, file_iter, options, pdf_render_workers)
+            return
+
+        found_files_count = 0
+        processed_items_count = 0
+
+        try:
+            for entry, relative_path, handler in file_iter:
+                found_files_count += 1
+                # Обработчик изображения или PDF (постранично), см. _EXT_DISPATCH
+                for metadata, image_object in handler(entry, relative_path, options):
+                    if metadata is not None:
+                        processed_items_count += 1
+                    yield metadata, image_object
+
+        except FileNotFoundError:
+            logger.error(f"Входная директория не найдена при сканировании: {input_dir_abs}")
+        except Exception as e:
+            logger.error(f"Ошибка при сканировании директории {input_dir_abs}: {e}", exc_info=True)
+
+        logger.info(f"Сканирование завершено. Найдено поддерживаемых файлов: {found_files_count}. Обработано элементов (страниц/изображений): {processed_items_count}")
+    finally:
+        # Пустая временная директория страниц удаляется сразу (страницы удаляет вызывающий код)
+        if own_page_dir:
+            try:
+                os.rmdir(page_dir)
+            except OSError:
+                pass
+
+
+# Маркер конца потока элементов в очереди предвыборки
+_SENTINEL = object()
+
+
+def _item_nbytes(image_object) -> int:
+    """
+    Объем памяти декодированного элемента (для бюджета max_inflight_bytes).
+    Для путей и байтов возвращает 0: они малы и не поддерживают weakref.
+    """
+    if isinstance(image_object, np.ndarray):
+        return image_object.nbytes
+    if isinstance(image_object, Image.Image):
+        return image_object.width * image_object.height * len(image_object.getbands())
+    return 0
+
+
+def iterate_document_items(input_dir_abs: str, config: dict):
+    """
+    Генератор, обходящий input_dir_abs, находящий поддерживаемые файлы
+    (изображения и PDF) и возвращающий (yields) для каждой страницы/изображения
+    кортеж (metadata, pil_image). Обрабатывает PDF постранично.
+
+    Args:
+        input_dir_abs (str): Абсолютный путь к директории с входными файлами.
+        config (dict): Словарь конфигурации.
+
+    Yields:
+        tuple: Кортеж вида (dict, PIL.Image.Image), где dict - метаданные,
+               а PIL.Image.Image - изображение. Либо (None, None) при ошибке.
+               При pdf_page_format: 'numpy' страницы PDF отдаются как np.ndarray
+               (H, W, 3) uint8 RGB, а в метаданные добавляются 'shape' и 'dtype'.
+               Изображение принадлежит вызывающему коду: генератор не хранит
+               на него ссылок и не закрывает его.
+               При yield_mode: 'path' вместо изображения отдается путь к файлу
+               (для страниц PDF - к временному PNG, metadata['temp_file'] = True,
+               удаляет его вызывающий код), при 'encoded' - байты файла
+               изображения или PNG-байты страницы. Такие элементы дешево
+               передаются в пул процессов.
+
+    При prefetch_depth > 0 обход и рендеринг выполняются в фоновом потоке:
+    следующая страница готовится, пока вызывающий код распознает текущую.
+    Объем отданных, но еще не освобожденных вызывающим кодом изображений
+    ограничен max_inflight_mb: следующая страница не рендерится, пока с ней
+    (по размеру предыдущей) бюджет был бы превышен. Поэтому вызывающий код
+    должен освобождать изображения, а не накапливать их (иначе обход
+    остановится; max_inflight_mb: 0 - без ограничения).
+    """
+    prefetch_depth = config.get('prefetch_depth', 2)
+    if not prefetch_depth or prefetch_depth <= 0:
+        yield from _iterate_items(input_dir_abs, config)
+        return
+
+    # Ограниченная очередь: производитель опережает потребителя не более чем на prefetch_depth элементов
+    items = queue.Queue(maxsize=prefetch_depth)
+    stop = threading.Event()
+
+    # Бюджет памяти: байты отданных изображений, на которые у потребителя еще есть ссылки.
+    # Освобождение отслеживается через weakref.finalize.
+    max_inflight_bytes = int(config.get('max_inflight_mb', 512) or 0) * 1024 * 1024
+    budget = threading.Condition()
+    inflight_bytes = 0
+
+    def release(nbytes):
+        nonlocal inflight_bytes
+        with budget:
+            inflight_bytes -= nbytes
+            budget.notify_all()
+
+    def wait_for_budget(last_nbytes):
+        """
+        Ждет, пока в бюджет поместится следующий элемент (оценка - размер последнего,
+        last_nbytes). На последний элемент может ссылаться сам приостановленный генератор
+        обхода, поэтому освобождения его ждать нельзя: одна страница проходит всегда.
+        """
+        with budget:
+            while (inflight_bytes > last_nbytes and inflight_bytes + last_nbytes > max_inflight_bytes
+                   and not stop.is_set()):
+                budget.wait(timeout=0.1)
+
+    def producer():
+        nonlocal inflight_bytes
+        try:
+            source = _iterate_items(input_dir_abs, config)
+            last_nbytes = 0 # Размер предыдущего изображения - оценка следующего
+            while True:
+                # Бюджет проверяется до рендеринга/декодирования следующей страницы, а не после
+                if max_inflight_bytes:
+                    wait_for_budget(last_nbytes)
+                    if stop.is_set():
+                        return
+                item = next(source, _SENTINEL)
+                if item is _SENTINEL:
+                    break
+                nbytes = _item_nbytes(item[1]) if max_inflight_bytes else 0
+                if nbytes:
+                    with budget:
+                        inflight_bytes += nbytes
+                    weakref.finalize(item[1], release, nbytes)
+                    last_nbytes = nbytes
+                # Ждем места в очереди, периодически проверяя, не остановлен ли потребитель
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                item = None # Ссылку на изображение держит только потребитель
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            items.put(e)
+            return
+        items.put(_SENTINEL)
+
+    thread = threading.Thread(target=producer, name='ocr-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _SENTINEL:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+            item = None # Не держим ссылку на отданное изображение, пока ждем следующее (бюджет памяти)
+    finally:
+        # Потребитель закончил (или прервал обход): останавливаем производителя
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 # --- Тестовый блок ---
 if __name__ == '__main__':
     # Создадим временные директории и файлы для теста
@@ -1,19 +1,296 @@
+import functools
 import logging
+import os
 import cv2
 import numpy as np
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING: # PIL нужен только для аннотаций (страницы приходят уже декодированными)
+    from PIL import Image
 
 logger = logging.getLogger(__name__)
 
-def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
+# Пул потоков для обработки страницы полосами (создается при первом использовании)
+_tile_pool = None
+_tile_pool_workers = None
+
+def image_to_array(image) -> np.ndarray:
+    """
+    Возвращает изображение как NumPy array: (H, W) для grayscale, (H, W, 3) RGB или (H, W, 4) RGBA.
+    np.ndarray (страницы PDF в режиме 'numpy') возвращается как есть, без копирования.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if image.mode not in ('RGB', 'L', 'RGBA'):
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+@dataclass
+class PreprocContext:
+    """
+    Буферы preprocess_image, переиспользуемые между страницами: для страниц одного
+    размера (типично для сканов PDF) память под промежуточные изображения выделяется
+    один раз. Изображение, возвращенное preprocess_image с контекстом, может лежать
+    в этих буферах и действительно только до следующего вызова с тем же контекстом.
+    Один контекст - на один поток обработки.
+    """
+    gray_buf: np.ndarray | None = None   # Результат RGB -> grayscale
+    warp_buf: np.ndarray | None = None   # Повернутая страница (deskew)
+    thresh_buf: np.ndarray | None = None # Результат бинаризации / удаления шума
+
+
+def _context_buffer(ctx: PreprocContext | None, name: str, shape: tuple) -> np.ndarray | None:
+    """Буфер uint8 нужной формы из контекста (пересоздается при смене размера страницы)."""
+    if ctx is None:
+        return None
+    buf = getattr(ctx, name)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(ctx, name, buf)
+    return buf
+
+
+def _to_gray(arr: np.ndarray, dst: np.ndarray | None = None) -> np.ndarray:
+    """Одно преобразование RGB(A) -> grayscale (без промежуточного BGR)."""
+    if arr.ndim == 2:
+        return arr
+    return cv2.cvtColor(arr, cv2.COLOR_RGBA2GRAY if arr.shape[2] == 4 else cv2.COLOR_RGB2GRAY, dst=dst)
+
+
+def _to_bgr(arr: np.ndarray) -> np.ndarray:
+    """Преобразование в стандартный для OpenCV BGR (только когда на выходе нужен цвет)."""
+    if arr.ndim == 2:
+        return cv2.cvtColor(arr, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(arr, cv2.COLOR_RGBA2BGR if arr.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+
+
+def _local_steps(image: np.ndarray, binarize: tuple | None, denoise: tuple | None,
+                 dst: np.ndarray | None = None) -> np.ndarray:
+    """
+    Бинаризация и удаление шума для изображения или его полосы.
+    Обе операции локальные: результат в пикселе зависит только от окрестности
+    радиусом не больше _tile_halo(binarize, denoise).
+    dst - буфер для результата последней операции (None - новый массив).
+    """
+    if binarize is not None:
+        binarize_dst = dst if denoise is None else None
+        if binarize[0] == 'otsu':
+            image = cv2.threshold(image, binarize[1], 255, cv2.THRESH_BINARY, dst=binarize_dst)[1]
+        else:
+            _, block_size, c_value = binarize
+            image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                          cv2.THRESH_BINARY, block_size, c_value, dst=binarize_dst)
+    if denoise is not None:
+        filter_name, kernel_size = denoise
+        if filter_name == 'median':
+            image = cv2.medianBlur(image, kernel_size, dst=dst)
+        elif filter_name == 'gaussian':
+            # Сепарабельный фильтр: два одномерных прохода вместо окна k x k
+            image = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0, dst=dst)
+        else:
+            # Усреднение по окну - самый дешевый сепарабельный фильтр
+            image = cv2.blur(image, (kernel_size, kernel_size), dst=dst)
+    return image
+
+
+def _tile_halo(binarize: tuple | None, denoise: tuple | None) -> int:
+    """Сколько строк соседних полос нужно захватить, чтобы результат совпал с обработкой целиком."""
+    halo = 0
+    if binarize is not None and binarize[0] == 'adaptive':
+        halo += binarize[1] // 2
+    if denoise is not None:
+        halo += denoise[1] // 2
+    return halo
+
+
+def _get_tile_pool(workers: int | None) -> ThreadPoolExecutor:
+    """Пул потоков для обработки полос (OpenCV отпускает GIL на время вычислений)."""
+    global _tile_pool, _tile_pool_workers
+    workers = workers or os.cpu_count() or 1
+    if _tile_pool is None or _tile_pool_workers != workers:
+        if _tile_pool is not None:
+            _tile_pool.shutdown()
+        _tile_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preprocess-tile')
+        _tile_pool_workers = workers
+    return _tile_pool
+
+
+def _run_in_tiles(image: np.ndarray, binarize: tuple | None, denoise: tuple | None,
+                  tile_rows: int, workers: int | None, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Применяет _local_steps горизонтальными полосами по tile_rows строк (с перекрытием),
+    параллельно в пуле потоков. Полоса целиком помещается в кэш процессора между
+    операциями, вместо нескольких проходов по всей странице. Результат совпадает
+    с обработкой страницы целиком. tile_rows = 0 - без разбиения.
+    out - буфер для результата (той же формы, что image; None - новый массив).
+    """
+    h = image.shape[0]
+    if not tile_rows or h <= tile_rows:
+        return _local_steps(image, binarize, denoise, dst=out)
+
+    halo = _tile_halo(binarize, denoise)
+    result = out
+
+    def process_tile(y: int) -> None:
+        nonlocal result
+        y0, y1 = max(0, y - halo), min(h, y + tile_rows + halo)
+        tile = _local_steps(image[y0:y1], binarize, denoise)
+        if result is None:
+            result = np.empty((h,) + tile.shape[1:], dtype=tile.dtype)
+        rows = min(tile_rows, h - y)
+        result[y:y + rows] = tile[y - y0:y - y0 + rows]
+
+    # Первая полоса - в текущем потоке: по ней определяется форма и тип результата
+    process_tile(0)
+    list(_get_tile_pool(workers).map(process_tile, range(tile_rows, h, tile_rows)))
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _cuda_available() -> bool:
+    """Есть ли в сборке OpenCV модуль cuda с warpAffine и хотя бы одно CUDA-устройство (проверяется один раз)."""
+    try:
+        available = hasattr(cv2, 'cuda') and hasattr(cv2.cuda, 'warpAffine') \
+            and cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except cv2.error:
+        available = False
+    if not available:
+        logger.warning("use_gpu включен, но OpenCV собран без CUDA или GPU не найден. Вращение выполняется на CPU.")
+    return available
+
+
+def _warp_affine_gpu(image: np.ndarray, M: np.ndarray, size: tuple) -> np.ndarray:
+    """
+    Поворот страницы (как cv2.warpAffine в deskew) на GPU: загрузка, вращение
+    и выгрузка ставятся в один cuda.Stream, CPU ждет только их завершения.
+    """
+    stream = cv2.cuda.Stream()
+    gpu_image = cv2.cuda.GpuMat()
+    gpu_image.upload(image, stream)
+    gpu_rotated = cv2.cuda.warpAffine(gpu_image, M, size, flags=cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255, 255),
+                                      stream=stream)
+    result = gpu_rotated.download(stream)
+    stream.waitForCompletion()
+    return result
+
+
+def _sheared_variance_py(padded, shifts, start, h):
+    """
+    Дисперсия профиля страницы при сдвиге полосы s на shifts[s] строк: сумма полос
+    padded[start + r + shifts[s], s] по каждой строке r и дисперсия этих сумм
+    (как padded[rows + shifts, cols].sum(axis=1).var(), но без временных массивов).
+    """
+    strips = padded.shape[1]
+    row_sums = np.empty(h, dtype=np.float64)
+    total = 0.0
+    for r in range(h):
+        row_sum = 0.0
+        for s in range(strips):
+            row_sum += padded[start + r + shifts[s], s]
+        row_sums[r] = row_sum
+        total += row_sum
+    mean = total / h
+    variance = 0.0
+    for r in range(h):
+        d = row_sums[r] - mean
+        variance += d * d
+    return variance / h
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_sheared_variance():
+    """
+    Компилирует _sheared_variance_py через numba (опциональная зависимость; импорт
+    и загрузка из кэша - один раз на процесс). None, если numba не установлен.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True, nogil=True)(_sheared_variance_py)
+
+
+def _estimate_skew_angle(small: np.ndarray, max_angle: float, strips: int = 16,
+                         use_numba: bool = True) -> float | None:
+    """
+    Оценивает угол наклона текста по профилю проекции: строки текста дают самый
+    "контрастный" профиль сумм по строкам (максимум дисперсии), когда они горизонтальны.
+    Поворот приближается сдвигом: страница делится на вертикальные полосы, профиль
+    каждой полосы считается один раз, а для угла a полоса сдвигается на x * tan(a) строк.
+    Перебор: от -max_angle до max_angle шагом 1 градус, затем уточнение шагом 0.1.
+
+    Args:
+        small (np.ndarray): Уменьшенная grayscale копия страницы (темный текст на светлом фоне).
+        max_angle (float): Максимальный искомый угол наклона в градусах.
+        strips (int): Число вертикальных полос.
+        use_numba (bool): Считать дисперсию скомпилированным ядром, если numba установлен.
+
+    Returns:
+        float | None: Угол для cv2.getRotationMatrix2D, выравнивающий страницу;
+                      None, если на странице нет текста.
+    """
+    h, w = small.shape[:2]
+    strips = max(1, min(strips, w))
+    edges = np.linspace(0, w, strips + 1).astype(np.intp)
+    # Профили полос по "чернилам" (255 - яркость); вычитаем среднее полосы, чтобы фон
+    # и нулевые поля при сдвиге не влияли на дисперсию
+    profiles = np.add.reduceat(cv2.bitwise_not(small), edges[:-1], axis=1, dtype=np.int64).astype(np.float64)
+    profiles -= profiles.mean(axis=0)
+    if not profiles.any():
+        return None
+
+    centers = (edges[:-1] + edges[1:]) / 2.0 - w / 2.0
+    pad = int(np.ceil(w / 2 * np.tan(np.radians(min(abs(max_angle) + 1, 89))))) + 1
+    padded = np.zeros((h + 2 * pad, strips), dtype=np.float64)
+    padded[pad:pad + h] = profiles
+    rows = np.arange(pad, pad + h)[:, None]
+    cols = np.arange(strips)[None, :]
+    # С numba дисперсия для угла считается одним проходом, без выборки (h, strips) на каждый угол
+    sheared_variance = _compiled_sheared_variance() if use_numba else None
+
+    def score(angle: float) -> tuple:
+        shifts = np.rint(centers * np.tan(np.radians(angle))).astype(np.intp)
+        if sheared_variance is not None:
+            variance = sheared_variance(padded, shifts, pad, h)
+        else:
+            variance = float(padded[rows + shifts[None, :], cols].sum(axis=1).var())
+        return variance, -abs(angle) # При равенстве - меньший угол (пустые/однородные страницы)
+
+    best = max(np.arange(-max_angle, max_angle + 1e-9, 1.0), key=score)
+    best = max(np.arange(best - 1.0, best + 1.0 + 1e-9, 0.1), key=score)
+    return float(round(best, 2)) + 0.0 # + 0.0: без "-0.0" в логах
+
+
+def warm_up_deskew(config: dict) -> None:
+    """
+    Заранее компилирует (или загружает из кэша numba) ядро оценки наклона на маленьком
+    тестовом изображении, чтобы это не приходилось на первую страницу процесса.
+    Ничего не делает без deskew или use_numba.
+    """
+    if not (config.get('deskew', False) and config.get('use_numba', True)):
+        return
+    dummy = np.full((32, 32), 255, dtype=np.uint8)
+    dummy[15:17] = 0 # Строка "текста": пустая страница вернула бы None до вызова ядра
+    _estimate_skew_angle(dummy, 1)
+
+
+def preprocess_image(pil_image: 'Image.Image', config: dict,
+                     context: PreprocContext | None = None) -> np.ndarray | None:
     """
     Выполняет предобработку изображения для OCR с использованием OpenCV.
 
     Args:
-        pil_image (PIL.Image.Image): Входное изображение в формате PIL.
+        pil_image (PIL.Image.Image): Входное изображение в формате PIL
+                                     (или np.ndarray RGB / grayscale).
         config (dict): Словарь с настройками предобработки из секции 'preprocessing'.
                        Пример: {'enabled': True, 'grayscale': True, 'deskew': True,
                                 'binarization_method': 'otsu', 'noise_removal': 'median_3'}
+        context (PreprocContext | None): Буферы для переиспользования между страницами.
+                       Результат тогда действителен только до следующего вызова с этим контекстом.
 
     Returns:
         np.ndarray | None: Обработанное изображение в формате NumPy array (OpenCV BGR или Grayscale),
@@ -23,7 +300,7 @@ def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
         logger.info("Предобработка отключена в конфигурации.")
         # Конвертируем PIL Image в OpenCV BGR формат (стандартный для OpenCV)
         try:
-            open_cv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+            open_cv_image = _to_bgr(image_to_array(pil_image))
             return open_cv_image
         except Exception as e:
             logger.error(f"Ошибка конвертации PIL Image в OpenCV: {e}", exc_info=True)
@@ -31,18 +308,18 @@ def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
 
     logger.info("Начало предобработки изображения...")
     try:
-        # 1. Конвертация PIL Image в OpenCV формат (NumPy array BGR)
-        # PIL использует RGB, OpenCV использует BGR
-        img = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-        working_image = img.copy() # Работаем с копией
+        # 1. Конвертация PIL Image в NumPy array (RGB или grayscale, без копии для np.ndarray)
+        img = image_to_array(pil_image)
 
         # 2. Преобразование в оттенки серого (Grayscale)
-        # Многие операции (deskew, binarization) и сам Tesseract лучше работают с grayscale
+        # Многие операции (deskew, binarization) и сам Tesseract лучше работают с grayscale.
+        # RGB -> grayscale одним вызовом cvtColor; BGR строится, только если на выходе нужен цвет.
+        # Копия не нужна: cvtColor, warpAffine и threshold пишут результат в новые буферы.
         use_grayscale = config.get('grayscale', True) # По умолчанию используем grayscale
         gray = None
         if use_grayscale or config.get('deskew') or config.get('binarization_method'):
             try:
-                gray = cv2.cvtColor(working_image, cv2.COLOR_BGR2GRAY)
+                gray = _to_gray(img, _context_buffer(context, 'gray_buf', img.shape[:2]) if img.ndim == 3 else None)
                 working_image = gray # Далее работаем с grayscale, если оно нужно
                 logger.debug("Изображение преобразовано в оттенки серого.")
             except cv2.error as e:
@@ -50,50 +327,56 @@ def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
                 # Если не удалось, но grayscale требовался для других шагов, может быть проблема
                 # Но лучше попытаться продолжить, чем упасть
                 gray = None # Явно указываем, что grayscale не доступен
+                working_image = _to_bgr(img)
+        else:
+            working_image = _to_bgr(img)
 
 
         # 3. Коррекция наклона (Deskew)
         if config.get('deskew', False) and gray is not None: # Deskew требует grayscale
             logger.debug("Применение коррекции наклона (deskew)...")
             try:
-                # Используем инвертированную бинаризацию Оцу для выделения текста
-                thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
-
-                # Находим координаты всех пикселей текста
-                coords = np.column_stack(np.where(thresh > 0))
-
-                if coords.shape[0] < 5: # Проверка, что есть достаточно точек для minAreaRect
-                    logger.warning("Недостаточно точек для определения угла наклона. Пропуск deskew.")
+                # Угол наклона - глобальное свойство страницы: оцениваем его на уменьшенной копии
+                # (длинная сторона ~deskew_estimate_size), а вращаем полноразмерное изображение
+                estimate_size = config.get('deskew_estimate_size', 1000)
+                (h, w) = gray.shape[:2]
+                scale = max(1, max(h, w) // estimate_size) if estimate_size else 1
+                if scale > 1:
+                    small = cv2.resize(gray, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+                    logger.debug(f"Оценка угла наклона на копии {w // scale}x{h // scale} (1/{scale}).")
                 else:
-                     # Находим минимальный ограничивающий прямоугольник
-                    rect = cv2.minAreaRect(coords)
-                    angle = rect[-1] # Угол в диапазоне [-90, 0)
+                    small = gray
 
-                    # Корректируем угол для функции вращения
-                    if angle < -45:
-                        angle = -(90 + angle)
-                    else:
-                        angle = -angle
+                # Угол по профилю проекции строк (без бинаризации и поиска контура текста)
+                angle = _estimate_skew_angle(small, config.get('deskew_max_angle', 15),
+                                             use_numba=config.get('use_numba', True))
 
+                if angle is None:
+                    logger.warning("Недостаточно текста для определения угла наклона. Пропуск deskew.")
+                else:
                     logger.info(f"Обнаружен угол наклона: {angle:.2f} градусов.")
 
                     # Вращаем изображение для компенсации наклона
                     # Tesseract лучше справляется с небольшим наклоном, поэтому вращаем только если угол значителен
                     if abs(angle) > 0.5 and abs(angle) < 45: # Порог для вращения (можно сделать настраиваемым)
-                         (h, w) = working_image.shape[:2] # Используем размеры working_image (может быть gray или BGR)
+                         (h, w) = working_image.shape[:2] # working_image здесь всегда grayscale
                          center = (w // 2, h // 2)
                          M = cv2.getRotationMatrix2D(center, angle, 1.0)
 
-                         # Вращаем working_image (может быть gray или BGR)
+                         # Вращаем grayscale working_image
                          # Используем белую рамку, т.к. часто фон белый
-                         working_image = cv2.warpAffine(working_image, M, (w, h),
-                                                      flags=cv2.INTER_CUBIC, # Качественная интерполяция
-                                                      borderMode=cv2.BORDER_CONSTANT,
-                                                      borderValue=(255, 255, 255) if len(working_image.shape) == 3 else 255) # Белая граница
+                         if config.get('use_gpu', False) and _cuda_available():
+                             working_image = _warp_affine_gpu(working_image, M, (w, h))
+                         else:
+                             working_image = cv2.warpAffine(working_image, M, (w, h),
+                                                          dst=_context_buffer(context, 'warp_buf', (h, w)),
+                                                          flags=cv2.INTER_LINEAR, # Билинейная: для малых углов не хуже кубической, в разы быстрее
+                                                          borderMode=cv2.BORDER_CONSTANT,
+                                                          borderValue=255) # Белая граница
                          logger.debug(f"Изображение повернуто на {-angle:.2f} градусов.")
-                         # Если вращали цветное изображение, надо обновить и grayscale версию, если она была
-                         if len(working_image.shape) == 3 and use_grayscale:
-                             gray = cv2.cvtColor(working_image, cv2.COLOR_BGR2GRAY)
+                         # Повернутое изображение и есть новая grayscale версия (повторный cvtColor не нужен);
+                         # дальше бинаризация работает уже с выровненной страницей
+                         gray = working_image
                     else:
                         logger.debug(f"Угол наклона ({angle:.2f}) слишком мал или велик, вращение пропущено.")
 
@@ -105,24 +388,23 @@ def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
         # --- Tesseract 4+ обычно лучше работает с grayscale, чем с бинаризованными ---
         # --- Оставляем бинаризацию как опцию, но по умолчанию не используем ---
 
-        # 4. Бинаризация (Преобразование в ч/б)
+        # 4. Бинаризация (Преобразование в ч/б) - разбор настроек
         binarization_method = config.get('binarization_method', None)
+        binarize = None # Параметры бинаризации для _local_steps
         if binarization_method and gray is not None: # Требует grayscale
              logger.debug(f"Применение бинаризации (метод: {binarization_method})...")
              try:
                 if binarization_method == 'otsu':
-                     # Глобальная бинаризация Оцу
-                     _, working_image = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-                     logger.debug("Применена бинаризация Оцу.")
+                     # Порог Оцу - глобальный: считаем его по всей странице, к полосам применяем готовый
+                     otsu_threshold = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]
+                     binarize = ('otsu', otsu_threshold)
+                     logger.debug(f"Бинаризация Оцу (порог: {otsu_threshold:.0f}).")
                 elif binarization_method == 'adaptive':
                      # Адаптивная бинаризация (хорошо для неравномерного освещения)
                      block_size = config.get('adaptive_thresh_block_size', 11) # Должен быть нечетным
                      c_value = config.get('adaptive_thresh_C', 2)
-                     working_image = cv2.adaptiveThreshold(gray, 255,
-                                                           cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                                           cv2.THRESH_BINARY,
-                                                           block_size, c_value)
-                     logger.debug(f"Применена адаптивная бинаризация (block: {block_size}, C: {c_value}).")
+                     binarize = ('adaptive', block_size, c_value)
+                     logger.debug(f"Адаптивная бинаризация (block: {block_size}, C: {c_value}).")
                 else:
                      logger.warning(f"Неизвестный метод бинаризации: {binarization_method}. Бинаризация пропущена.")
                      # Если метод неизвестен, working_image остается grayscale (или BGR, если grayscale не удался)
@@ -134,25 +416,35 @@ def preprocess_image(pil_image: Image.Image, config: dict) -> np.ndarray | None:
              logger.warning("Бинаризация пропущена, так как не удалось получить grayscale изображение.")
 
 
-        # 5. Удаление шума
+        # 5. Удаление шума - разбор настроек
         noise_method = config.get('noise_removal', None)
+        denoise = None # (фильтр, размер ядра) для _local_steps
         if noise_method:
             logger.debug(f"Применение удаления шума (метод: {noise_method})...")
             try:
-                if noise_method.startswith('median_'):
-                    kernel_size_str = noise_method.split('_')[-1]
+                filter_name, _, kernel_size_str = noise_method.partition('_')
+                if filter_name in ('median', 'gaussian', 'box'):
                     kernel_size = int(kernel_size_str)
-                    if kernel_size % 2 == 1: # Медианный фильтр требует нечетный размер ядра
-                        working_image = cv2.medianBlur(working_image, kernel_size)
-                        logger.debug(f"Применен Median Blur с ядром {kernel_size}x{kernel_size}.")
+                    if kernel_size % 2 == 1: # Все фильтры требуют нечетный размер ядра
+                        denoise = (filter_name, kernel_size)
                     else:
-                         logger.warning(f"Размер ядра для Median Blur должен быть нечетным, получен {kernel_size}. Шум не удален.")
+                         logger.warning(f"Размер ядра для фильтра {filter_name} должен быть нечетным, получен {kernel_size}. Шум не удален.")
                 else:
                     logger.warning(f"Неизвестный метод удаления шума: {noise_method}. Пропущено.")
             except ValueError:
                  logger.warning(f"Некорректный размер ядра в 'noise_removal': {noise_method}. Пропущено.")
+
+        # 4-5. Бинаризация и удаление шума - локальные операции, выполняются полосами
+        if binarize or denoise:
+            try:
+                source = gray if binarize else working_image
+                working_image = _run_in_tiles(source, binarize, denoise,
+                                              config.get('tile_rows', 512), config.get('tile_workers'),
+                                              out=_context_buffer(context, 'thresh_buf', source.shape))
+                logger.debug(f"Бинаризация/удаление шума применены: {binarize}, {denoise}.")
             except Exception as e:
-                 logger.error(f"Ошибка при удалении шума: {e}", exc_info=True)
+                 logger.error(f"Ошибка при бинаризации/удалении шума: {e}", exc_info=True)
+                 # Продолжаем с тем, что было до этих шагов
 
         # --- Финальное изображение для Tesseract ---
         # Tesseract обычно лучше работает с Grayscale или BGR.
@@ -191,6 +483,7 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     # Создадим тестовое изображение PIL
+    from PIL import Image
     test_pil_image = Image.new('RGB', (400, 100), color='lightgray')
     # Можно добавить текст для теста deskew, но для простоты оставим так
     print("Создано тестовое PIL изображение.")
@@ -1,40 +1,79 @@
+import functools
+import importlib
 import logging
-import pytesseract
+import os
+import shlex
+import sys
+import tempfile
+import cv2
 import numpy as np
-from PIL import Image # Только для type hinting и возможной отладки
+
+# tesserocr (прямые привязки к C API Tesseract) - опционально: изображение передается
+# движку из памяти, без временных файлов и запуска процесса на каждую страницу
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
 
 logger = logging.getLogger(__name__)
 
-def extract_text(image_array: np.ndarray, config: dict) -> str | None:
+
+class _LazyModule:
+    """
+    Модуль, импортируемый при первом обращении к его атрибуту. pytesseract
+    импортируется около 0.1 с, а с tesserocr он может не понадобиться вовсе.
     """
-    Извлекает текст из изображения с использованием Tesseract OCR.
 
-    Args:
-        image_array (np.ndarray): Изображение в формате NumPy array
-                                  (предпочтительно Grayscale или BGR,
-                                  как возвращает image_processor).
-        config (dict): Словарь с настройками OCR. Должен содержать ключи:
-                       'lang' (str): Язык(и) Tesseract (e.g., 'rus', 'eng', 'rus+eng').
-                       'tesseract_cmd' (str | None): Путь к исполняемому файлу tesseract.
-                                                    None - если tesseract в PATH.
-                       'tessdata_dir' (str | None): Путь к директории tessdata.
-                                                   None - использовать стандартную.
-                       'ocr_config' (str): Дополнительные параметры для Tesseract
-                                          (e.g., '--psm 3 --oem 1').
+    def __init__(self, name: str):
+        self._name = name
 
-    Returns:
-        str | None: Распознанный текст или None в случае ошибки.
+    def __getattr__(self, attr: str):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+pytesseract = _LazyModule('pytesseract')
+
+# Последний установленный tesseract_cmd: глобальная переменная pytesseract трогается только при его смене
+_current_cmd = None
+
+# Инициализированный экземпляр tesserocr и ключ его настроек (lang, tessdata_dir, ocr_config)
+_tess_api = None
+_tess_api_key = None
+# Ключ настроек, с которыми инициализация tesserocr не удалась (чтобы не повторять ее на каждой странице)
+_tess_api_failed_key = None
+
+
+@functools.lru_cache(maxsize=8)
+def _build_custom_config(tessdata_dir: str | None, ocr_config_str: str) -> str:
     """
-    logger.info("Запуск OCR...")
+    Собирает строку конфигурации Tesseract из ocr_config и tessdata_dir.
+    Результат кэшируется: для всех страниц с одинаковыми настройками строка собирается один раз.
+    """
+    custom_config = ocr_config_str.strip()
+    if tessdata_dir:
+        # Добавляем параметр --tessdata-dir, если он еще не задан в ocr_config_str
+        if '--tessdata-dir' not in custom_config:
+            custom_config = f'--tessdata-dir "{tessdata_dir}" {custom_config}'.strip()
+            logger.debug(f"Используется кастомная директория tessdata: {tessdata_dir}")
+        else:
+             logger.warning(f"--tessdata-dir указан и в 'tessdata_dir', и в 'ocr_config'. Используется значение из 'ocr_config': {custom_config}")
+    return custom_config
+
 
+def _prepare_ocr_params(config: dict) -> tuple[str, str]:
+    """
+    Применяет tesseract_cmd и возвращает (lang, строка конфигурации Tesseract).
+    Общая часть extract_text и extract_text_batch.
+    """
     # 1. Получаем параметры из конфига
     lang = config.get('lang', 'rus')
     tesseract_cmd = config.get('tesseract_cmd')
     tessdata_dir = config.get('tessdata_dir')
-    ocr_config_str = config.get('ocr_config', '').strip()
+    ocr_config_str = config.get('ocr_config', '')
 
-    # 2. Устанавливаем путь к tesseract, если он указан
-    if tesseract_cmd:
+    # 2. Устанавливаем путь к tesseract, если он указан и изменился с прошлого вызова
+    global _current_cmd
+    if tesseract_cmd and tesseract_cmd != _current_cmd:
         logger.debug(f"Указан путь к Tesseract: {tesseract_cmd}")
         # Эта строка изменяет глобальную переменную в pytesseract для этого сеанса Python
         # Делать это можно, но если вы планируете многопоточность,
@@ -45,80 +84,274 @@ def extract_text(image_array: np.ndarray, config: dict) -> str | None:
             # Проверяем, отличается ли он от текущего, чтобы не вызывать лишний раз
             if pytesseract.pytesseract.tesseract_cmd != tesseract_cmd:
                  pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+            _current_cmd = tesseract_cmd
         except AttributeError:
              logger.error("Не удалось установить tesseract_cmd. Возможно, старая версия pytesseract?")
         except Exception as e:
              logger.error(f"Непредвиденная ошибка при установке tesseract_cmd: {e}")
 
+    # 3. Собираем строку конфигурации для Tesseract (из кэша при тех же настройках)
+    custom_config = _build_custom_config(tessdata_dir, ocr_config_str or '')
+    return lang, custom_config
 
-    # 3. Собираем строку конфигурации для Tesseract
-    custom_config = ocr_config_str
-    if tessdata_dir:
-        # Добавляем параметр --tessdata-dir, если он еще не задан в ocr_config_str
-        if '--tessdata-dir' not in custom_config:
-            custom_config = f'--tessdata-dir "{tessdata_dir}" {custom_config}'.strip()
-            logger.debug(f"Используется кастомная директория tessdata: {tessdata_dir}")
-        else:
-             logger.warning(f"--tessdata-dir указан и в 'tessdata_dir', и в 'ocr_config'. Используется значение из 'ocr_config': {custom_config}")
-
-    logger.info(f"Параметры OCR: Язык='{lang}', Конфиг='{custom_config}'")
 
-    # 4. Выполняем OCR
+@functools.lru_cache(maxsize=8)
+def _parse_tesserocr_options(ocr_config_str: str) -> dict | None:
+    """
+    Разбирает ocr_config для tesserocr: --psm, --oem, --tessdata-dir и -c имя=значение.
+    Возвращает None, если встречены другие параметры (тогда используется pytesseract).
+    """
+    options = {'psm': None, 'oem': None, 'tessdata_dir': None, 'variables': {}}
+    tokens = shlex.split(ocr_config_str)
+    i = 0
     try:
-        # Конвертируем NumPy array обратно в PIL Image формат,
-        # т.к. pytesseract часто лучше работает с ним напрямую
-        # Или убедимся что наш NumPy array правильного формата
-        if image_array is None:
-            logger.error("Получено пустое изображение (None) для OCR.")
-            return None
-
-        # Проверка типа данных, Tesseract обычно ожидает uint8
-        if image_array.dtype != np.uint8:
-            logger.warning(f"Тип данных изображения ({image_array.dtype}) не uint8. Попытка конвертации...")
-            try:
-                # Нормализация если нужно (например, если пришли float 0-1)
-                if image_array.max() <= 1.0 and image_array.min() >= 0:
-                    image_array = (image_array * 255).astype(np.uint8)
-                else:
-                    # Простое приведение типа, может привести к потере данных, если диапазон не 0-255
-                    image_array = image_array.astype(np.uint8)
-            except Exception as conv_err:
-                logger.error(f"Ошибка конвертации типа данных изображения в uint8: {conv_err}. OCR может не сработать.")
+        while i < len(tokens):
+            token = tokens[i]
+            if token in ('--psm', '--oem'):
+                options[token[2:]] = int(tokens[i + 1])
+                i += 2
+            elif token == '--tessdata-dir':
+                options['tessdata_dir'] = tokens[i + 1]
+                i += 2
+            elif token == '-c' and '=' in tokens[i + 1]:
+                name, value = tokens[i + 1].split('=', 1)
+                options['variables'][name] = value
+                i += 2
+            else:
+                logger.debug(f"Параметр Tesseract '{token}' не поддерживается tesserocr, используется pytesseract.")
                 return None
+    except (IndexError, ValueError):
+        logger.warning(f"Некорректная строка ocr_config: '{ocr_config_str}'.")
+        return None
+    return options
 
-        # --- Основной вызов pytesseract ---
-        # Передаем NumPy array напрямую (pytesseract умеет с ними работать)
-        extracted_text = pytesseract.image_to_string(
-            image_array,
-            lang=lang,
-            config=custom_config
-        )
 
-        logger.info(f"OCR успешно завершен. Извлечено символов: {len(extracted_text)}")
-        # Логируем только начало текста для отладки
-        logger.debug(f"Начало извлеченного текста:\n---\n{extracted_text[:200]}\n---")
+def _get_tess_api(lang: str, tessdata_dir: str | None, ocr_config_str: str):
+    """
+    Возвращает экземпляр PyTessBaseAPI для текущих настроек (создается один раз и
+    переиспользуется между страницами). None - если tesserocr недоступен или не подходит.
+    """
+    global _tess_api, _tess_api_key, _tess_api_failed_key
+    if PyTessBaseAPI is None:
+        return None
+    key = (lang, tessdata_dir, ocr_config_str)
+    if _tess_api is not None and _tess_api_key == key:
+        return _tess_api
+    if _tess_api_failed_key == key:
+        return None
 
-        return extracted_text
+    options = _parse_tesserocr_options(ocr_config_str)
+    if options is None:
+        return None
+    if _tess_api is not None:
+        _tess_api.End()
+        _tess_api = _tess_api_key = None
+
+    init_kwargs = {'lang': lang}
+    tessdata_path = options['tessdata_dir'] or tessdata_dir
+    if tessdata_path:
+        init_kwargs['path'] = tessdata_path
+    if options['psm'] is not None:
+        init_kwargs['psm'] = options['psm']
+    if options['oem'] is not None:
+        init_kwargs['oem'] = options['oem']
+    try:
+        api = PyTessBaseAPI(**init_kwargs)
+    except RuntimeError as e:
+        logger.error(f"Не удалось инициализировать tesserocr: {e}. Используется pytesseract.")
+        _tess_api_failed_key = key
+        return None
+    for name, value in options['variables'].items():
+        if not api.SetVariable(name, value):
+            logger.warning(f"Tesseract не принял переменную '{name}={value}'.")
+    logger.info(f"Инициализирован tesserocr (Язык='{lang}', tessdata='{tessdata_path or 'по умолчанию'}').")
+    _tess_api, _tess_api_key = api, key
+    return api
 
-    except pytesseract.TesseractNotFoundError:
+
+def _tesserocr_text(api, image_array: np.ndarray) -> str:
+    """Передает буфер изображения в Tesseract напрямую (без кодирования в файл) и возвращает текст."""
+    if image_array.ndim == 3:
+        # Tesseract ожидает RGB, image_processor отдает BGR
+        image_array = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+    image_array = np.ascontiguousarray(image_array)
+    height, width = image_array.shape[:2]
+    bytes_per_pixel = 1 if image_array.ndim == 2 else image_array.shape[2]
+    api.SetImageBytes(image_array.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+    return api.GetUTF8Text()
+
+
+def _log_ocr_error(e: Exception, suffix: str = '') -> None:
+    """
+    Логирует ошибку OCR. Типы ошибок pytesseract проверяются, только если он уже
+    импортирован: сама проверка не должна импортировать его (путь tesserocr).
+    """
+    pytesseract_module = sys.modules.get('pytesseract')
+    if pytesseract_module is not None and isinstance(e, pytesseract_module.TesseractNotFoundError):
         logger.critical(
             "ОШИБКА: Tesseract не найден. Убедитесь, что он установлен и "
             "путь к нему прописан в системной переменной PATH или в 'tesseract_cmd' в config.yaml."
         )
-        # После такой ошибки продолжать бессмысленно, хорошо бы остановить весь процесс.
-        # Можно бросить исключение выше, чтобы main.py его поймал и завершился.
-        # Например: raise pytesseract.TesseractNotFoundError
-        # Но пока просто вернем None, чтобы обработать как ошибку элемента.
-        return None
-    except pytesseract.TesseractError as e:
-        logger.error(f"Ошибка во время выполнения Tesseract: {e}", exc_info=True)
+        # После такой ошибки продолжать бессмысленно, но пока элемент просто считается
+        # ошибочным (вызывающий код получает None).
+    elif pytesseract_module is not None and isinstance(e, pytesseract_module.TesseractError):
         # Эта ошибка может возникать из-за проблем с языковыми данными, параметрами и т.д.
+        logger.error(f"Ошибка во время выполнения Tesseract{suffix}: {e}", exc_info=True)
+    else:
+        logger.error(f"Непредвиденная ошибка во время OCR{suffix}: {e}", exc_info=True)
+
+
+def _check_dtype(image_array: np.ndarray) -> None:
+    """Tesseract ожидает 8 бит; preprocess_image всегда отдает uint8, поэтому конвертации нет - только проверка."""
+    if image_array.dtype != np.uint8:
+        raise TypeError(f"OCR ожидает изображение uint8, получен {image_array.dtype}")
+
+
+def warm_up(config: dict) -> None:
+    """
+    Заранее создает экземпляр Tesseract API (tesserocr) для настроек config, чтобы
+    загрузка языковой модели не приходилась на первую страницу. Экземпляр живет
+    до конца процесса и переиспользуется всеми вызовами extract_text с теми же настройками.
+    Ничего не делает для backend 'pytesseract' и без tesserocr.
+    """
+    if config.get('backend', 'auto') != 'pytesseract':
+        _get_tess_api(config.get('lang', 'rus'), config.get('tessdata_dir'), config.get('ocr_config', '') or '')
+
+
+def extract_text(image_array: np.ndarray, config: dict) -> str | None:
+    """
+    Извлекает текст из изображения с использованием Tesseract OCR.
+
+    Args:
+        image_array (np.ndarray): Изображение в формате NumPy array uint8
+                                  (Grayscale или BGR, как возвращает image_processor).
+        config (dict): Словарь с настройками OCR. Должен содержать ключи:
+                       'lang' (str): Язык(и) Tesseract (e.g., 'rus', 'eng', 'rus+eng').
+                       'tesseract_cmd' (str | None): Путь к исполняемому файлу tesseract.
+                                                    None - если tesseract в PATH.
+                       'tessdata_dir' (str | None): Путь к директории tessdata.
+                                                   None - использовать стандартную.
+                       'ocr_config' (str): Дополнительные параметры для Tesseract
+                                          (e.g., '--psm 3 --oem 1').
+                       'backend' (str): 'auto' (tesserocr, если установлен, иначе pytesseract),
+                                        'tesserocr' или 'pytesseract'.
+
+    Returns:
+        str | None: Распознанный текст или None в случае ошибки.
+
+    Raises:
+        TypeError: Изображение не uint8 (ошибка вызывающего кода, а не OCR).
+    """
+    logger.info("Запуск OCR...")
+
+    if image_array is None:
+        logger.error("Получено пустое изображение (None) для OCR.")
         return None
+    _check_dtype(image_array)
+
+    lang, custom_config = _prepare_ocr_params(config)
+    logger.info(f"Параметры OCR: Язык='{lang}', Конфиг='{custom_config}'")
+
+    # 4. Выполняем OCR
+    try:
+        # --- tesserocr: буфер изображения напрямую в C API, без временного файла и процесса ---
+        api = None
+        if config.get('backend', 'auto') != 'pytesseract':
+            api = _get_tess_api(lang, config.get('tessdata_dir'), config.get('ocr_config', '') or '')
+            if api is None and config.get('backend') == 'tesserocr':
+                logger.warning("tesserocr недоступен или не поддерживает заданный ocr_config, используется pytesseract.")
+
+        if api is not None:
+            extracted_text = _tesserocr_text(api, image_array)
+        else:
+            # --- Основной вызов pytesseract ---
+            # Передаем NumPy array напрямую (pytesseract умеет с ними работать)
+            extracted_text = pytesseract.image_to_string(
+                image_array,
+                lang=lang,
+                config=custom_config
+            )
+
+        logger.info(f"OCR успешно завершен. Извлечено символов: {len(extracted_text)}")
+        # Логируем только начало текста для отладки
+        logger.debug(f"Начало извлеченного текста:\n---\n{extracted_text[:200]}\n---")
+
+        return extracted_text
+
     except Exception as e:
-        logger.error(f"Непредвиденная ошибка во время OCR: {e}", exc_info=True)
+        _log_ocr_error(e)
         return None
 
 
+def extract_text_batch(image_arrays: list, config: dict) -> list:
+    """
+    Распознает несколько изображений одним запуском Tesseract (список файлов
+    на входе), без запуска процесса и загрузки языковых моделей на каждую страницу.
+
+    Args:
+        image_arrays (list[np.ndarray]): Изображения uint8 (Grayscale или BGR, как возвращает image_processor).
+        config (dict): Настройки OCR, как для extract_text.
+
+    Returns:
+        list[str | None]: Текст для каждого изображения в том же порядке;
+                          None для изображений, которые не удалось распознать.
+
+    Raises:
+        TypeError: Какое-либо изображение не uint8.
+    """
+    if not image_arrays:
+        return []
+    for image_array in image_arrays:
+        if image_array is not None:
+            _check_dtype(image_array)
+    logger.info(f"Запуск пакетного OCR для {len(image_arrays)} изображений...")
+    lang, custom_config = _prepare_ocr_params(config)
+    logger.info(f"Параметры OCR: Язык='{lang}', Конфиг='{custom_config}'")
+
+    results = [None] * len(image_arrays)
+    try:
+        with tempfile.TemporaryDirectory(prefix='ocrpipe_batch_') as tmp_dir:
+            # 1. Страницы во временные PNG (минимальное сжатие) и их список для Tesseract
+            page_indexes = []
+            page_paths = []
+            for index, image_array in enumerate(image_arrays):
+                if image_array is None:
+                    logger.error(f"Получено пустое изображение (None) для OCR (позиция {index}).")
+                    continue
+                page_path = os.path.join(tmp_dir, f"page_{index:05d}.png")
+                cv2.imwrite(page_path, image_array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                page_indexes.append(index)
+                page_paths.append(page_path)
+            if not page_paths:
+                return results
+
+            list_path = os.path.join(tmp_dir, 'images.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(page_paths) + '\n')
+
+            # 2. Один процесс tesseract на все страницы (команда собирается так же, как в pytesseract)
+            output_base = os.path.join(tmp_dir, 'output')
+            pytesseract.pytesseract.run_tesseract(list_path, output_base, 'txt', lang, custom_config)
+            with open(output_base + '.txt', encoding='utf-8') as f:
+                output_text = f.read()
+
+        # 3. Tesseract разделяет страницы символом перевода формата (\f)
+        page_texts = output_text.split('\f')
+        if len(page_texts) < len(page_paths):
+            logger.error(f"Пакетный OCR вернул {len(page_texts)} страниц вместо {len(page_paths)}. "
+                         f"Результаты пакета отброшены.")
+            return results
+        for index, text in zip(page_indexes, page_texts):
+            results[index] = text
+
+        logger.info(f"Пакетный OCR успешно завершен: {len(page_paths)} изображений.")
+        return results
+
+    except Exception as e:
+        _log_ocr_error(e, ' (пакетный OCR)')
+        return results
+
+
 # Пример использования (только для демонстрации вызова, нужен NumPy array)
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -164,4 +397,9 @@ if __name__ == '__main__':
     if result_text_2 is None:
         print("Тест 2 успешно показал ошибку (вернул None), как и ожидалось.")
     else:
-        print(f"Тест 2 неожиданно вернул текст:\n---\n{result_text_2}\n---")
\ No newline at end of file
+        print(f"Тест 2 неожиданно вернул текст:\n---\n{result_text_2}\n---")
+
+    # --- Тест 3: Пакетный OCR (один процесс tesseract на несколько изображений) ---
+    print("\n--- Тест 3: Пакетный OCR ---")
+    result_texts_3 = extract_text_batch([fake_image, fake_image, None], test_config_1)
+    print(f"Тест 3 Результат: {result_texts_3}")
@@ -0,0 +1,135 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from core import ocr_engine
+
+logger = logging.getLogger(__name__)
+
+# Пул процессов OCR переиспользуется между вызовами ocr_pages (пока не изменились настройки)
+_pool = None
+_pool_key = None
+
+# Настройки OCR в процессе-воркере (задаются инициализатором пула)
+_worker_config = None
+
+
+def _init_worker(config: dict) -> None:
+    """
+    Инициализатор процесса-воркера: запоминает настройки и сразу создает
+    экземпляр Tesseract API (tesserocr), который живет, пока жив воркер.
+    """
+    global _worker_config
+    _worker_config = config
+    ocr_engine.warm_up(config)
+
+
+def _ocr_shared_page(shm_name: str, shape: tuple, dtype: str) -> str | None:
+    """Распознает страницу из разделяемой памяти (выполняется в процессе-воркере)."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        text = ocr_engine.extract_text(image_array, _worker_config)
+        del image_array # Освобождаем ссылку на буфер до закрытия разделяемой памяти
+        return text
+    finally:
+        shm.close()
+
+
+def _get_pool(workers: int, config: dict) -> ProcessPoolExecutor:
+    """Возвращает пул процессов OCR, пересоздавая его при смене числа воркеров или настроек."""
+    global _pool, _pool_key
+    key = (workers, tuple(sorted(config.items())))
+    if _pool is not None and _pool_key == key:
+        return _pool
+    shutdown()
+    logger.info(f"Запуск пула OCR: {workers} процессов.")
+    # Tesseract сам распараллеливает распознавание через OpenMP; при нескольких процессах
+    # это только мешает (как и в main.py). Переменная наследуется процессами-воркерами.
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    # spawn: вызывающий процесс может быть многопоточным, а fork скопировал бы и его
+    # экземпляр Tesseract API
+    _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker, initargs=(config,))
+    _pool_key = key
+    return _pool
+
+
+def shutdown() -> None:
+    """Останавливает пул процессов OCR (если он был запущен)."""
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = _pool_key = None
+
+
+def ocr_pages(image_arrays: list, config: dict, workers: int | None = None) -> list:
+    """
+    Распознает страницы параллельно в пуле процессов. Каждый воркер держит
+    свой экземпляр Tesseract API, инициализированный один раз; изображения
+    передаются воркерам через разделяемую память, без pickle массивов.
+
+    Args:
+        image_arrays (list[np.ndarray]): Изображения uint8 (как возвращает image_processor).
+        config (dict): Настройки OCR, как для ocr_engine.extract_text.
+        workers (int | None): Число процессов (None - по числу ядер).
+
+    Returns:
+        list[str | None]: Текст для каждого изображения в том же порядке;
+                          None для изображений, которые не удалось распознать.
+    """
+    if not image_arrays:
+        return []
+    workers = workers or os.cpu_count() or 1
+    pool = _get_pool(workers, config)
+
+    results = [None] * len(image_arrays)
+    segments = []
+    futures = []
+    try:
+        for index, image_array in enumerate(image_arrays):
+            if image_array is None:
+                logger.error(f"Получено пустое изображение (None) для OCR (позиция {index}).")
+                continue
+            image_array = np.ascontiguousarray(image_array)
+            # Одна копия страницы в разделяемую память вместо pickle + передачи по каналу
+            shm = shared_memory.SharedMemory(create=True, size=max(1, image_array.nbytes))
+            segments.append(shm)
+            np.ndarray(image_array.shape, dtype=image_array.dtype, buffer=shm.buf)[...] = image_array
+            futures.append((index, pool.submit(_ocr_shared_page, shm.name, image_array.shape, image_array.dtype.str)))
+
+        for index, future in futures:
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка OCR в процессе-воркере (позиция {index}): {e}", exc_info=True)
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+    logger.info(f"Параллельный OCR завершен: {sum(text is not None for text in results)} из {len(results)} изображений.")
+    return results
+
+
+# Пример использования
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    import cv2
+    fake_image = np.full((100, 400), 255, dtype=np.uint8)
+    cv2.putText(fake_image, "Test OCR 123", (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+
+    test_config = {
+        'lang': 'eng',
+        'tesseract_cmd': None,
+        'tessdata_dir': None,
+        'ocr_config': '--psm 6',
+    }
+    texts = ocr_pages([fake_image] * 4, test_config, workers=2)
+    print(f"Результаты: {texts}")
+    shutdown()
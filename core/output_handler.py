@@ -1,11 +1,42 @@
+import atexit
+import functools
 import json
 import logging
 import os
+import queue
 import re
 import shutil # Импортируем для использования в тестовом блоке
+import tempfile
+import threading
+
+# orjson (сериализация на C/Rust, сразу в UTF-8) - опционально, иначе стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Фоновая запись результатов (async_save): очередь (путь, JSON-байты) и поток записи
+_WRITE_QUEUE_DEPTH = 64
+_write_queue = None
+_writer_thread = None
+_write_errors = 0
+_STOP = object()
+
+# Права для файлов результатов, как у open(): 0666 с учетом umask (umask читается только
+# через установку, поэтому один раз при импорте)
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o666 & ~_umask
+
+# Последовательности недопустимых символов: разрешаем буквы (в т.ч. русские), цифры,
+# подчеркивание, дефис и точку
+_RE_BAD_CHARS = re.compile(r'[^\w.\-а-яА-ЯёЁ]+', re.UNICODE)
+_RE_UNDERSCORES = re.compile(r'_+')
+
+# Имя исходного файла одинаково для всех его страниц - очищаем его один раз
+@functools.lru_cache(maxsize=1024)
 def sanitize_filename(filename):
     """Удаляет или заменяет недопустимые символы из имени файла."""
     if not filename:
@@ -17,9 +48,9 @@ def sanitize_filename(filename):
     # Заменяем пробелы и последовательности не буквенно-цифровых символов на подчеркивание
     # Разрешаем русские буквы, цифры, дефис и подчеркивание
     # Добавляем точку в разрешенные символы на всякий случай
-    sanitized_name = re.sub(r'[^\w.\-а-яА-ЯёЁ]+', '_', name_part, flags=re.UNICODE)
+    sanitized_name = _RE_BAD_CHARS.sub('_', name_part)
     # Удаляем последовательные подчеркивания
-    sanitized_name = re.sub(r'_+', '_', sanitized_name)
+    sanitized_name = _RE_UNDERSCORES.sub('_', sanitized_name)
     # Удаляем лидирующие/завершающие подчеркивания
     sanitized_name = sanitized_name.strip('_')
     # Если имя стало пустым после очистки, используем 'unnamed'
@@ -27,6 +58,82 @@ def sanitize_filename(filename):
         sanitized_name = 'unnamed_file'
     return sanitized_name
 
+# Директория результатов одна на весь запуск: создаем (проверяем) ее один раз, а не на каждую страницу
+@functools.lru_cache(maxsize=64)
+def _ensure_dir(path: str) -> None:
+    """Создает директорию, если ее нет (однократно для каждого пути)."""
+    os.makedirs(path, exist_ok=True)
+
+def _dump_json(data: dict) -> bytes:
+    """Сериализует данные в JSON (UTF-8, отступ 2) через orjson, если он установлен."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+def _write_atomic(output_path: str, payload: bytes) -> None:
+    """
+    Пишет файл через временный файл и os.replace: частично записанный JSON не появится.
+    Временный файл уникален, поэтому одновременная запись в один путь (одинаковые имена
+    в разных папках) не ломает os.replace - остается результат последнего писателя.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', suffix='.tmp')
+    try:
+        # mkstemp создает файл с правами 0600; выставляем обычные для open() права
+        os.chmod(tmp_path, _FILE_MODE)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _writer_loop(write_queue: queue.Queue) -> None:
+    """Поток записи: сохраняет результаты из очереди, пока не получит _STOP."""
+    global _write_errors
+    while True:
+        item = write_queue.get()
+        if item is _STOP:
+            return
+        output_path, payload = item
+        try:
+            _write_atomic(output_path, payload)
+            logger.info(f"Результат успешно сохранен: {output_path}")
+        except OSError as e:
+            _write_errors += 1
+            logger.error(f"Ошибка ввода-вывода при сохранении файла {output_path}: {e}", exc_info=True)
+
+def _enqueue_write(output_path: str, payload: bytes) -> None:
+    """Передает запись потоку записи (запускает его при первом вызове). Блокирует, только если очередь полна."""
+    global _write_queue, _writer_thread
+    if _writer_thread is None:
+        _write_queue = queue.Queue(maxsize=_WRITE_QUEUE_DEPTH)
+        _writer_thread = threading.Thread(target=_writer_loop, args=(_write_queue,),
+                                          name='result-writer', daemon=True)
+        _writer_thread.start()
+    _write_queue.put((output_path, payload))
+
+def flush_results() -> int:
+    """
+    Дожидается записи всех результатов, поставленных в очередь в режиме async_save,
+    и останавливает поток записи.
+
+    Returns:
+        int: Число результатов, которые не удалось записать с момента прошлого вызова.
+    """
+    global _write_queue, _writer_thread, _write_errors
+    if _writer_thread is not None:
+        _write_queue.put(_STOP)
+        _writer_thread.join()
+        _write_queue = _writer_thread = None
+    failed, _write_errors = _write_errors, 0
+    return failed
+
+# Не теряем очередь записи, если программа завершается без явного flush_results
+atexit.register(flush_results)
+
 def save_result(data_to_save: dict,
                 output_dir_abs: str,
                 original_filename: str,
@@ -35,6 +142,8 @@ def save_result(data_to_save: dict,
     """
     Сохраняет обработанные данные (словарь data_to_save) в JSON файл.
     Имя файла генерируется на основе original_filename и page_num.
+    При config['async_save'] файл пишется в фоновом потоке (сериализация - сразу),
+    ошибки записи возвращает flush_results().
 
     Args:
         data_to_save (dict): Словарь с данными для сохранения (в новой структуре).
@@ -63,11 +172,14 @@ def save_result(data_to_save: dict,
         logger.info(f"Попытка сохранения результата в файл: {output_path}")
 
         # 3. Создаем директорию, если нужно
-        os.makedirs(output_dir_abs, exist_ok=True)
+        _ensure_dir(output_dir_abs)
 
         # 4. Сохраняем ПЕРЕДАННЫЕ данные data_to_save в JSON
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2) # indent=2
+        payload = _dump_json(data_to_save)
+        if config.get('async_save', False):
+            _enqueue_write(output_path, payload)
+            return True
+        _write_atomic(output_path, payload)
 
         logger.info(f"Результат успешно сохранен: {output_path}")
         return True
@@ -77,6 +189,7 @@ def save_result(data_to_save: dict,
         return False
     except TypeError as e:
         # Часто возникает, если пытаемся сериализовать неподдерживаемый тип
+        # (orjson.JSONEncodeError - тоже подкласс TypeError)
         logger.error(f"Ошибка типа данных при сериализации в JSON для {output_path}: {e}", exc_info=True)
         return False
     except Exception as e:
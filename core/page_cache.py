@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт PNG страниц, прочитанных с диска кэша, держать еще и в памяти
+MEMORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Индексы дисковых кэшей: cache_dir -> OrderedDict(ключ -> размер файла), от старых к новым
+_disk_indexes = {}
+_disk_sizes = {}
+# cache_dir -> префикс пути с разделителем (пути файлов кэша собираются конкатенацией, без os.path.join)
+_dir_prefixes = {}
+# Кэш в памяти: (cache_dir, ключ) -> PNG-байты, и их общий размер
+_memory_cache = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+
+
+def _make_key(path: str, mtime_ns: int, page_num: int, dpi: int, max_long_edge_px: int) -> str:
+    """Ключ страницы: sha1 от пути, mtime исходного файла, номера страницы и настроек разрешения."""
+    return hashlib.sha1(f"{path}|{mtime_ns}|{page_num}|{dpi}|{max_long_edge_px}".encode('utf-8')).hexdigest()
+
+
+def _load_index(cache_dir: str) -> OrderedDict:
+    """
+    Возвращает индекс файлов дискового кэша. При первом обращении сканирует
+    директорию и упорядочивает файлы по времени последнего использования (mtime).
+    """
+    index = _disk_indexes.get(cache_dir)
+    if index is not None:
+        return index
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.png') and entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                entries.append((st.st_mtime_ns, entry.name[:-4], st.st_size))
+    entries.sort()
+    index = OrderedDict((key, size) for _, key, size in entries)
+    _disk_indexes[cache_dir] = index
+    _disk_sizes[cache_dir] = sum(index.values())
+    _dir_prefixes[cache_dir] = cache_dir if cache_dir.endswith(os.sep) else cache_dir + os.sep
+    logger.debug(f"Кэш страниц '{cache_dir}': {len(index)} файлов, {_disk_sizes[cache_dir]} байт.")
+    return index
+
+
+def _forget(cache_dir: str, key: str) -> None:
+    """Удаляет страницу из кэша в памяти (если она там есть)."""
+    global _memory_bytes
+    png_bytes = _memory_cache.pop((cache_dir, key), None)
+    if png_bytes is not None:
+        _memory_bytes -= len(png_bytes)
+
+
+def _remember(cache_dir: str, key: str, png_bytes: bytes) -> None:
+    """
+    Кладет страницу, прочитанную с диска, в кэш в памяти с вытеснением самых старых
+    (по общему размеру). Только что отрендеренные страницы сюда не попадают: за один
+    запуск страница запрашивается один раз, повторно - только при чтении с диска.
+    """
+    global _memory_bytes
+    if len(png_bytes) > MEMORY_CACHE_MAX_BYTES:
+        return
+    _forget(cache_dir, key)
+    _memory_cache[(cache_dir, key)] = png_bytes
+    _memory_bytes += len(png_bytes)
+    while _memory_bytes > MEMORY_CACHE_MAX_BYTES:
+        _, old_bytes = _memory_cache.popitem(last=False)
+        _memory_bytes -= len(old_bytes)
+
+
+def get(cache_dir: str, path: str, mtime_ns: int, page_num: int, dpi: int,
+        max_long_edge_px: int = 0) -> bytes | None:
+    """
+    Ищет отрендеренную страницу в кэше.
+
+    Args:
+        cache_dir (str): Директория дискового кэша.
+        path (str): Путь к исходному PDF.
+        mtime_ns (int): st_mtime_ns исходного файла (изменение файла инвалидирует кэш).
+        page_num (int): Номер страницы (с 1).
+        dpi (int): Разрешение рендеринга.
+        max_long_edge_px (int): Ограничение длинной стороны страницы в пикселях (0 - без ограничения).
+
+    Returns:
+        bytes | None: Страница в формате PNG или None, если ее нет в кэше.
+    """
+    key = _make_key(path, mtime_ns, page_num, dpi, max_long_edge_px)
+    with _lock:
+        cached = _memory_cache.get((cache_dir, key))
+        if cached is not None:
+            _memory_cache.move_to_end((cache_dir, key))
+            return cached
+
+        index = _load_index(cache_dir)
+        if key not in index:
+            return None
+        file_path = f"{_dir_prefixes[cache_dir]}{key}.png"
+        try:
+            with open(file_path, 'rb') as f:
+                png_bytes = f.read()
+            os.utime(file_path) # Отмечаем использование для LRU между запусками
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать страницу из кэша '{file_path}': {e}")
+            _disk_sizes[cache_dir] -= index.pop(key)
+            return None
+        index.move_to_end(key)
+        _remember(cache_dir, key, png_bytes)
+        return png_bytes
+
+
+def put(cache_dir: str, path: str, mtime_ns: int, page_num: int, dpi: int, png_bytes: bytes,
+        max_bytes: int, max_long_edge_px: int = 0) -> None:
+    """
+    Сохраняет отрендеренную страницу (PNG) в кэш. Если размер дискового кэша
+    превышает max_bytes, удаляются давно не использованные страницы.
+    Ошибки записи только логируются: кэш не должен ломать обработку.
+    """
+    key = _make_key(path, mtime_ns, page_num, dpi, max_long_edge_px)
+    with _lock:
+        try:
+            index = _load_index(cache_dir)
+            file_path = f"{_dir_prefixes[cache_dir]}{key}.png"
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png_bytes)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить страницу в кэш '{cache_dir}': {e}")
+            return
+
+        _disk_sizes[cache_dir] += len(png_bytes) - index.pop(key, 0)
+        index[key] = len(png_bytes)
+        _forget(cache_dir, key) # Страница перерендерена: старая копия в памяти устарела
+
+        # LRU-вытеснение, чтобы кэш не рос бесконечно
+        while _disk_sizes[cache_dir] > max_bytes and len(index) > 1:
+            old_key, old_size = index.popitem(last=False)
+            _disk_sizes[cache_dir] -= old_size
+            _forget(cache_dir, old_key)
+            try:
+                os.remove(f"{_dir_prefixes[cache_dir]}{old_key}.png")
+            except OSError:
+                pass
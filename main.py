@@ -1,21 +1,30 @@
 import yaml
 import logging
+import multiprocessing
 import os
 import sys
 import traceback
-from time import time
-from datetime import datetime, timezone
-from typing import Dict, Any, Optional, Tuple, List
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+from math import modf
+from time import time, perf_counter_ns, gmtime, strftime
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple, Union, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING: # PIL нужен только для аннотаций
+    from PIL import Image
 
 # --- Импорт модулей ядра ---
 try:
-    from utils.logger import setup_logging
-    from core.file_handler import iterate_document_items
-    from core.image_processor import preprocess_image
-    from core.ocr_engine import extract_text
+    from utils.logger import setup_logging, get_log_queue
+    from utils.helpers import raise_open_file_limit
+    from core.file_handler import iterate_document_items, load_item_image
+    from core.image_processor import preprocess_image, PreprocContext, image_to_array, warm_up_deskew
+    from core.ocr_engine import extract_text, warm_up
     from core.post_processor import clean_text # Используем обновленный post_processor
-    from core.output_handler import save_result
+    from core.output_handler import save_result, flush_results
 except ImportError as e:
     print(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось импортировать модуль ядра: {e}", file=sys.stderr)
     print("Пожалуйста, убедитесь, что все файлы (.py) находятся в правильных директориях (core/, utils/) и не содержат синтаксических ошибок.", file=sys.stderr)
@@ -23,8 +32,18 @@ except ImportError as e:
 
 # --- Константы ---
 CONFIG_FILE = 'config.yaml'
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) # Корень проекта: относительно него задаются input_dir/output_dir
 logger = logging.getLogger('main')
 
+# Словарь результата, переиспользуемый между страницами: save_result сериализует его сразу
+# (в том числе при async_save), поэтому после возврата его можно заполнять заново.
+# process_single_item в каждом процессе вызывается из одного потока.
+_output_data = {"document_info": {}, "processing_info": {}, "content": {}}
+
+# Настройки конвейера и буферы предобработки процесса-воркера (concurrency > 1), создаются в _init_item_worker
+_worker_pipeline_context = None
+_worker_preproc_context = None
+
 # --- Функции ---
 
 def load_config(config_path: str) -> Dict[str, Any]:
@@ -50,92 +69,219 @@ def load_config(config_path: str) -> Dict[str, Any]:
         sys.exit(1)
 
 
-def process_single_item(metadata: dict, image_object: Image.Image, config: dict, output_dir_abs: str) -> Tuple[bool, float]:
-    """ Полный цикл обработки одного элемента. """
-    item_start_time = time()
-    log_prefix = f"[{metadata.get('original_filename', 'N/A')} | Page {metadata.get('page_num', 'N/A')}]" # Используем original_filename для лога
+@dataclass(frozen=True, slots=True)
+class PipelineContext:
+    """ Настройки обработки элемента, разобранные из конфигурации один раз за запуск. """
+    config: dict            # Полная конфигурация (для save_result)
+    output_dir_abs: str     # Абсолютный путь к директории результатов
+    preproc_config: dict    # Секция 'preprocessing'
+    ocr_config: dict        # Настройки для ocr_engine.extract_text
+    postproc_config: dict   # Секция 'postprocessing'
+
+
+def make_pipeline_context(config: dict, output_dir_abs: str) -> PipelineContext:
+    """ Собирает PipelineContext из загруженной конфигурации. """
+    return PipelineContext(
+        config=config,
+        output_dir_abs=output_dir_abs,
+        preproc_config=config.get('preprocessing', {}),
+        ocr_config={
+            'lang': config.get('ocr_language', 'rus'),
+            'tessdata_dir': config.get('tessdata_dir'),
+            'tesseract_cmd': config.get('tesseract_cmd'),
+            'ocr_config': config.get('ocr_config', ''),
+            'backend': config.get('ocr_backend', 'auto')
+        },
+        postproc_config=config.get('postprocessing', {}),
+    )
+
+
+def _item_log_prefix(metadata: dict) -> str:
+    """ Префикс сообщений лога для элемента: '[имя файла | Page N]'. """
+    return f"[{metadata.get('original_filename', 'N/A')} | Page {metadata.get('page_num', 'N/A')}]" # Используем original_filename для лога
+
+
+# Последняя отформатированная секунда для _utc_timestamp: (секунда, 'YYYY-MM-DDTHH:MM:SS')
+_timestamp_cache = (None, None)
+
+
+def _utc_timestamp(t: float) -> str:
+    """ Метка времени UTC в формате ISO 8601 с миллисекундами: '2024-01-31T12:00:00.123Z'. """
+    global _timestamp_cache
+    # Как datetime.fromtimestamp: дробная часть - до микросекунд с округлением, затем отбрасываем лишние разряды
+    frac, seconds = modf(t)
+    seconds, us = int(seconds), round(frac * 1e6)
+    if us >= 1_000_000:
+        seconds, us = seconds + 1, us - 1_000_000
+    ms = us // 1000
+    cached_seconds, prefix = _timestamp_cache
+    if seconds != cached_seconds: # strftime - не чаще раза в секунду
+        prefix = strftime('%Y-%m-%dT%H:%M:%S', gmtime(seconds))
+        _timestamp_cache = (seconds, prefix)
+    return f"{prefix}.{ms:03d}Z"
+
+
+def process_single_item(metadata: dict, image_object: Union['Image.Image', np.ndarray, str, bytes],
+                        pipeline: PipelineContext, preproc_context: Optional[PreprocContext] = None) -> Tuple[bool, float]:
+    """ Полный цикл обработки одного элемента (изображение, NumPy array, путь или байты файла). """
+    item_start_ns = perf_counter_ns() # Монотонные часы: длительность не зависит от перевода системного времени
+    # Префикс нужен только для сообщений INFO и ниже; при более высоком уровне лога не форматируем его заранее
+    log_prefix = _item_log_prefix(metadata) if logger.isEnabledFor(logging.INFO) else ''
+    debug_enabled = logger.isEnabledFor(logging.DEBUG) # Отладочные сообщения не форматируются при уровне INFO и выше
     logger.info(f"{log_prefix} Обработка элемента начата (Источник: '{metadata.get('relative_path', '?')}')")
     success_flag = False
     duration = 0.0
+    # Временный PNG страницы (yield_mode: 'path') удаляется после обработки
+    temp_path = image_object if metadata.get('temp_file') else None
 
     try:
+        # Режимы yield_mode 'path'/'encoded': декодируем путь или байты здесь
+        image_object = load_item_image(image_object)
+
         # --- 1. Предобработка ---
-        preproc_config = config.get('preprocessing', {})
-        processed_image_np = preprocess_image(image_object, preproc_config)
+        processed_image_np = preprocess_image(image_object, pipeline.preproc_config, preproc_context)
         if processed_image_np is None:
             raise ValueError("Preprocessing failed")
-        logger.debug(f"{log_prefix} Предобработка завершена.")
+        # Исходное изображение больше не нужно: освобождаем буфер PIL.Image до OCR, а не после
+        if hasattr(image_object, 'close'):
+            image_object.close()
+        image_object = None
+        if debug_enabled:
+            logger.debug(f"{log_prefix} Предобработка завершена.")
 
         # --- 2. OCR ---
-        ocr_specific_config = {
-            'lang': config.get('ocr_language', 'rus'),
-            'tessdata_dir': config.get('tessdata_dir'),
-            'tesseract_cmd': config.get('tesseract_cmd'),
-            'ocr_config': config.get('ocr_config', '')
-        }
+        ocr_specific_config = pipeline.ocr_config
         raw_text = extract_text(processed_image_np, ocr_specific_config)
         del processed_image_np
         if raw_text is None:
             raise ValueError("OCR failed")
-        logger.debug(f"{log_prefix} OCR завершен, длина текста: {len(raw_text)}.")
+        if debug_enabled:
+            logger.debug(f"{log_prefix} OCR завершен, длина текста: {len(raw_text)}.")
 
         # --- 3. Постобработка ---
         # Используем обновленный post_processor для лучшей читаемости
-        postproc_config = config.get('postprocessing', {})
-        cleaned_text = clean_text(raw_text, postproc_config)
-        logger.debug(f"{log_prefix} Постобработка завершена, итоговая длина: {len(cleaned_text)}.")
+        cleaned_text = clean_text(raw_text, pipeline.postproc_config)
+        if debug_enabled:
+            logger.debug(f"{log_prefix} Постобработка завершена, итоговая длина: {len(cleaned_text)}.")
         del raw_text
 
         # --- 4. Формирование данных для JSON и сохранение ---
-        duration = time() - item_start_time # Текущая длительность
-
-        # Используем новую структуру JSON
-        output_data = {
-            "document_info": {
-                "input_directory": metadata.get('input_directory'), # Из file_handler
-                "relative_path": metadata.get('relative_path'),     # Из file_handler
-                "original_filename": metadata.get('original_filename'),# Из file_handler
-                "source_type": metadata.get('source_type'),         # Из file_handler
-                "page_number": metadata.get('page_num'),            # Из file_handler
-            },
-            "processing_info": {
-                "timestamp_utc": datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
-                "duration_sec": round(duration, 2),
-                "ocr_engine_lang": ocr_specific_config.get('lang', 'N/A'),
-                "tesseract_config_used": ocr_specific_config.get('ocr_config', 'N/A'),
-            },
-            "content": {
-                "text": cleaned_text # Здесь лежит очищенный текст с \n
-            }
-        }
+        duration = (perf_counter_ns() - item_start_ns) / 1e9 # Текущая длительность
+
+        # Используем новую структуру JSON (заполняем переиспользуемый словарь _output_data)
+        output_data = _output_data
+        document_info = output_data["document_info"]
+        document_info["input_directory"] = metadata.get('input_directory')     # Из file_handler
+        document_info["relative_path"] = metadata.get('relative_path')         # Из file_handler
+        document_info["original_filename"] = metadata.get('original_filename') # Из file_handler
+        document_info["source_type"] = metadata.get('source_type')             # Из file_handler
+        document_info["page_number"] = metadata.get('page_num')                # Из file_handler
+        processing_info = output_data["processing_info"]
+        processing_info["timestamp_utc"] = _utc_timestamp(time())
+        processing_info["duration_sec"] = round(duration, 2)
+        processing_info["ocr_engine_lang"] = ocr_specific_config.get('lang', 'N/A')
+        processing_info["tesseract_config_used"] = ocr_specific_config.get('ocr_config', 'N/A')
+        output_data["content"]["text"] = cleaned_text # Здесь лежит очищенный текст с \n
 
         # Вызов save_result не меняется
         save_success = save_result(
             data_to_save=output_data,
-            output_dir_abs=output_dir_abs,
+            output_dir_abs=pipeline.output_dir_abs,
             original_filename=metadata.get('original_filename', 'unknown'),
             page_num=metadata.get('page_num', 0),
-            config=config
+            config=pipeline.config
         )
+        output_data["content"]["text"] = None # Не держим текст страницы до следующего элемента
 
         if not save_success:
             raise ValueError("Saving failed")
 
         success_flag = True
-        duration = time() - item_start_time
+        duration = (perf_counter_ns() - item_start_ns) / 1e9
         logger.info(f"{log_prefix} Элемент успешно обработан и сохранен за {duration:.2f} сек.")
 
     except Exception as e:
         success_flag = False
-        duration = time() - item_start_time
-        logger.error(f"{log_prefix} Не удалось обработать элемент (ошибка: {type(e).__name__}). Время до ошибки: {duration:.2f} сек.")
+        duration = (perf_counter_ns() - item_start_ns) / 1e9
+        logger.error(f"{log_prefix or _item_log_prefix(metadata)} Не удалось обработать элемент (ошибка: {type(e).__name__}). Время до ошибки: {duration:.2f} сек.")
+
+    if temp_path is not None:
+        try:
+            os.remove(temp_path)
+        except OSError as e:
+            logger.warning(f"{log_prefix or _item_log_prefix(metadata)} Не удалось удалить временный файл страницы '{temp_path}': {e}")
 
     return success_flag, duration
 
 
+def _init_item_worker(config: dict, output_dir_abs: str, log_queue) -> None:
+    """
+    Инициализатор процесса-воркера: логирование (процессы запускаются через spawn; записи для
+    файла лога передаются главному процессу через log_queue), настройки, буферы предобработки
+    и экземпляр Tesseract API, который воркер использует для всех своих страниц.
+    """
+    global _worker_pipeline_context, _worker_preproc_context
+    try:
+        if log_queue is None:
+            # Файл лога в главном процессе не открыт - воркер тоже не пишет в него
+            config = {**config, 'logging': {**config.get('logging', {}), 'log_file': None}}
+        setup_logging(config, log_queue=log_queue)
+    except Exception as e:
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+        logger.error(f"Не удалось настроить логирование в процессе-воркере: {e}")
+    # Фоновая запись (async_save) в воркере не нужна: пока процесс пишет файл, другие воркеры
+    # распознают свои страницы; синхронная запись сразу дает результат save_result
+    _worker_pipeline_context = make_pipeline_context({**config, 'async_save': False}, output_dir_abs)
+    _worker_preproc_context = PreprocContext()
+    warm_up(_worker_pipeline_context.ocr_config)
+    warm_up_deskew(_worker_pipeline_context.preproc_config)
+
+
+def _process_item_in_worker(metadata: dict, image_object) -> Tuple[bool, float]:
+    """ process_single_item в процессе-воркере; результат записывается на диск до возврата (без async_save). """
+    return process_single_item(metadata, image_object, _worker_pipeline_context, _worker_preproc_context)
+
+
+def _process_shared_item_in_worker(metadata: dict, shm_name: str, shape: tuple, dtype: str) -> Tuple[bool, float]:
+    """ Обработка страницы из разделяемой памяти (созданной главным процессом) в процессе-воркере. """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _process_item_in_worker(metadata, image_array)
+        del image_array # Освобождаем ссылку на буфер до закрытия разделяемой памяти
+        return result
+    finally:
+        shm.close()
+
+
+def _share_array(image_array: np.ndarray) -> shared_memory.SharedMemory:
+    """ Копирует изображение в новый блок разделяемой памяти (освобождает вызывающий: close + unlink). """
+    shm = shared_memory.SharedMemory(create=True, size=image_array.nbytes)
+    np.ndarray(image_array.shape, dtype=image_array.dtype, buffer=shm.buf)[:] = image_array
+    return shm
+
+
+def _release_shared(shm: shared_memory.SharedMemory) -> None:
+    """ Закрывает и удаляет блок разделяемой памяти страницы. """
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _dir_has_entries(path: str) -> bool:
+    """ True, если директория существует и не пуста (читается только первая запись). """
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is not None
+    except OSError:
+        return False
+
+
 def main():
     """ Основная функция оркестратора OCR конвейера. """
-    script_start_time = time()
+    script_start_ns = perf_counter_ns()
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
     config = load_config(CONFIG_FILE)
@@ -148,12 +294,12 @@ def main():
 
     logger.info("="*30 + " Запуск OCR Pipeline " + "="*30)
     logger.info(f"PID процесса: {os.getpid()}")
+    raise_open_file_limit()
 
     input_dir = config.get('input_dir', 'input_data')
     output_dir = config.get('output_dir', 'output_data')
-    base_path = os.path.dirname(os.path.abspath(__file__))
-    input_dir_abs = os.path.join(base_path, input_dir)
-    output_dir_abs = os.path.join(base_path, output_dir)
+    input_dir_abs = os.path.join(BASE_DIR, input_dir)
+    output_dir_abs = os.path.join(BASE_DIR, output_dir)
 
     logger.info(f"Входная директория: {input_dir_abs}")
     logger.info(f"Выходная директория: {output_dir_abs}")
@@ -177,7 +323,57 @@ def main():
     processed_count = 0
     error_count = 0
     total_items_yielded = 0
-    successful_item_times: List[float] = []
+    # Для среднего времени успешного элемента: сумма и число (без списка на каждый элемент)
+    successful_time_sum = 0.0
+    successful_time_count = 0
+    # Настройки обработки элемента разбираются один раз; буферы предобработки
+    # общие для всех страниц (при последовательной обработке)
+    pipeline = make_pipeline_context(config, output_dir_abs)
+    preproc_context = PreprocContext()
+
+    def record_result(success: bool, duration: float) -> None:
+        nonlocal processed_count, error_count, successful_time_sum, successful_time_count
+        if success:
+            processed_count += 1
+            successful_time_sum += duration
+            successful_time_count += 1
+        else:
+            error_count += 1
+
+    def collect(futures) -> None:
+        for future in futures:
+            try:
+                record_result(*future.result())
+            except Exception as e:
+                logger.error(f"Ошибка в процессе-воркере: {e}", exc_info=True)
+                record_result(False, 0.0)
+            shm = shared_pages.pop(future, None)
+            if shm is not None:
+                _release_shared(shm)
+
+    # Параллельная обработка элементов в пуле процессов (concurrency > 1)
+    concurrency = config.get('concurrency') or os.cpu_count() or 1
+    executor = None
+    pending = set()
+    # Блоки разделяемой памяти со страницами, переданными воркерам: future -> SharedMemory
+    shared_pages = {}
+    if concurrency > 1:
+        # Tesseract сам распараллеливает распознавание через OpenMP; при нескольких процессах
+        # это только мешает. Переменная наследуется процессами-воркерами.
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+        # То же для пула потоков предобработки полосами: по умолчанию ядра делятся между воркерами
+        worker_config = config
+        preproc_config = config.get('preprocessing') or {}
+        if not preproc_config.get('tile_workers'):
+            tile_workers = max(1, (os.cpu_count() or 1) // concurrency)
+            worker_config = {**config, 'preprocessing': {**preproc_config, 'tile_workers': tile_workers}}
+        # spawn: главный процесс к этому моменту многопоточный (упреждающая загрузка страниц)
+        executor = ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_item_worker,
+                                       initargs=(worker_config, output_dir_abs, get_log_queue()))
+        logger.info(f"Параллельная обработка: {concurrency} процессов.")
+    else:
+        warm_up_deskew(pipeline.preproc_config)
 
     logger.info(f"Начало сканирования директории '{input_dir_abs}' и обработки документов...")
     try:
@@ -195,26 +391,57 @@ def main():
                 if metadata: del metadata
                 continue
 
-            # Обработка одного элемента
-            success, duration = process_single_item(metadata, image_object, config, output_dir_abs)
-
-            if success:
-                processed_count += 1
-                successful_item_times.append(duration)
+            if executor is None:
+                # Обработка одного элемента
+                record_result(*process_single_item(metadata, image_object, pipeline, preproc_context))
             else:
-                error_count += 1
+                if isinstance(image_object, (str, bytes)):
+                    pending.add(executor.submit(_process_item_in_worker, metadata, image_object))
+                else:
+                    # Пиксели передаются воркеру через разделяемую память (без pickle изображения),
+                    # в задаче - только имя блока, форма и тип массива
+                    image_array = image_to_array(image_object)
+                    shm = _share_array(image_array)
+                    try:
+                        future = executor.submit(_process_shared_item_in_worker, metadata, shm.name,
+                                                 image_array.shape, image_array.dtype.str)
+                    except Exception:
+                        _release_shared(shm)
+                        raise
+                    del image_array
+                    shared_pages[future] = shm
+                    pending.add(future)
+                # Не больше 2 * concurrency элементов в работе: изображения страниц занимают много памяти
+                if len(pending) >= 2 * concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
 
             # Освобождаем память
             del image_object
             del metadata
 
+        if pending:
+            done, pending = wait(pending)
+            collect(done)
+
     except Exception as e:
         logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА во время итерации и обработки файлов: {e}", exc_info=True)
         error_count = total_items_yielded - processed_count
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        for shm in shared_pages.values():
+            _release_shared(shm)
+
+    # Дожидаемся фоновой записи результатов (async_save) и учитываем ее ошибки
+    failed_writes = flush_results()
+    if failed_writes:
+        logger.error(f"Не удалось записать {failed_writes} результатов на диск.")
+        processed_count -= failed_writes
+        error_count += failed_writes
 
     # --- Завершение и статистика (без изменений от предыдущей версии) ---
-    script_end_time = time()
-    total_time = script_end_time - script_start_time
+    total_time = (perf_counter_ns() - script_start_ns) / 1e9
 
     logger.info("="*30 + " Завершение работы OCR Pipeline " + "="*30)
     logger.info(f"Всего элементов найдено/попытано обработать: {total_items_yielded}")
@@ -226,11 +453,11 @@ def main():
         avg_time_per_item_total = total_time / total_items_yielded
         logger.info(f"Среднее время на элемент (всего попыток): {avg_time_per_item_total:.2f} сек.")
     if processed_count > 0:
-        avg_time_per_item_success = sum(successful_item_times) / processed_count
+        avg_time_per_item_success = successful_time_sum / max(successful_time_count, 1)
         logger.info(f"Среднее время на УСПЕШНО обработанный элемент: {avg_time_per_item_success:.2f} сек.")
     elif total_items_yielded > 0:
          logger.info("Среднее время на успешный элемент: N/A (нет успешно обработанных).")
-    elif os.path.exists(input_dir_abs) and any(os.scandir(input_dir_abs)):
+    elif _dir_has_entries(input_dir_abs):
         logger.warning("Не найдено поддерживаемых файлов для обработки во входной директории (или они не были обработаны file_handler).")
     else:
         logger.info("Входная директория пуста или не существует.")
@@ -0,0 +1,24 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+def raise_open_file_limit(target: int = 10000) -> None:
+    """
+    Поднимает мягкий лимит открытых файлов (RLIMIT_NOFILE) до target, но не выше жесткого.
+    Конвертация PDF во временные файлы и пулы воркеров держат много дескрипторов
+    одновременно; на macOS мягкий лимит по умолчанию всего 256.
+    На платформах без модуля resource (Windows) ничего не делает.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        new_soft = target if hard == resource.RLIM_INFINITY else min(target, hard)
+        if soft != resource.RLIM_INFINITY and soft < new_soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            logger.debug(f"Лимит открытых файлов поднят: {soft} -> {new_soft}")
+    except (ValueError, OSError) as e:
+        logger.warning(f"Не удалось изменить лимит открытых файлов: {e}")
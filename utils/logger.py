@@ -1,7 +1,17 @@
+import atexit
 import logging
+import multiprocessing
+import multiprocessing.queues # До atexit.register ниже: _stop_file_listener должен выполниться раньше финализаторов multiprocessing
 import sys
 import os
-from logging.handlers import RotatingFileHandler
+import time
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Поток записи лога в файл (QueueListener) и его очередь: запущен, пока настроено логирование в файл.
+# Очередь - multiprocessing.Queue: в нее же пишут процессы-воркеры (см. get_log_queue)
+_file_listener = None
+_log_queue = None
 
 # --- Расширенный набор цветов ---
 class LogColors:
@@ -19,33 +29,60 @@ class ColoredFormatter(logging.Formatter):
     def __init__(self, fmt, datefmt=None, style='%', use_colors=True):
         super().__init__(fmt, datefmt, style)
         self.use_colors = use_colors
-        # Словарь цветов ТОЛЬКО для уровней
-        self.level_colors = {
+        # Словарь цветов ТОЛЬКО для уровней (нестандартные уровни - без цвета)
+        self.level_colors = defaultdict(lambda: LogColors.RESET, {
             logging.DEBUG: LogColors.GREY,
             logging.INFO: LogColors.GREEN,
             logging.WARNING: LogColors.YELLOW,
             logging.ERROR: LogColors.RED,
             logging.CRITICAL: LogColors.BOLD_RED,
-        }
-        # Базовый формат без цветов для фолбека и не-цветного вывода
-        self.base_formatter = logging.Formatter(fmt, datefmt, style)
+        })
+        # Шаблоны цветной строки для каждого уровня: цвета подставляются один раз здесь,
+        # а не при форматировании каждой записи
+        default_template = self._make_template(LogColors.RESET)
+        self.level_templates = defaultdict(lambda: default_template, {
+            level: self._make_template(color) for level, color in self.level_colors.items()
+        })
+        # Последняя отформатированная секунда: (int(record.created), строка даты)
+        self._time_cache = (None, None)
+
+    @staticmethod
+    def _make_template(level_color):
+        """Строка %-формата записи лога с цветом уровня level_color."""
+        return (
+            f"{LogColors.LIGHT_BLUE}%(asctime)s{LogColors.RESET} - "
+            f"{LogColors.CYAN}%(name)s{LogColors.RESET} - "
+            f"[{level_color}%(levelname)s{LogColors.RESET}] - "
+            "%(message)s" # Сообщение остается стандартного цвета терминала
+        )
+
+    def formatTime(self, record, datefmt=None):
+        """
+        Как logging.Formatter.formatTime, но strftime/localtime вызываются не чаще
+        раза в секунду: datefmt без долей секунды одинаков для всех записей этой секунды.
+        """
+        if not datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        cached_second, cached_str = self._time_cache
+        if second != cached_second:
+            cached_str = time.strftime(datefmt, self.converter(record.created))
+            self._time_cache = (second, cached_str)
+        return cached_str
 
     def format(self, record):
         if not self.use_colors:
-            # Если цвета не используются, используем базовый форматтер
-            return self.base_formatter.format(record)
+            # Если цвета не используются - обычное форматирование по fmt/datefmt, переданным в __init__
+            return super().format(record)
 
         # --- Форматируем с цветами ---
         # Выбираем цвет для уровня
-        level_color = self.level_colors.get(record.levelno, LogColors.RESET)
-
-        # Форматируем основные части лога
-        log_entry = (
-            f"{LogColors.LIGHT_BLUE}{self.formatTime(record, self.datefmt)}{LogColors.RESET} - "
-            f"{LogColors.CYAN}{record.name}{LogColors.RESET} - "
-            f"[{level_color}{record.levelname}{LogColors.RESET}] - "
-            f"{record.getMessage()}" # Сообщение остается стандартного цвета терминала
-        )
+        level_color = self.level_colors[record.levelno]
+
+        # Форматируем основные части лога по готовому шаблону уровня
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record, self.datefmt)
+        log_entry = self.level_templates[record.levelno] % record.__dict__
 
         # Обработка исключений (traceback) - выводим его цветом уровня
         if record.exc_info:
@@ -60,8 +97,36 @@ class ColoredFormatter(logging.Formatter):
 
         return log_entry
 
-def setup_logging(config):
-    """Настраивает систему логирования на основе конфигурации с кастомными цветами для консоли."""
+def _stop_file_listener():
+    """Дописывает в файл оставшиеся в очереди записи и останавливает поток записи лога."""
+    global _file_listener, _log_queue
+    if _file_listener is not None:
+        _file_listener.stop()
+        for handler in _file_listener.handlers:
+            handler.close()
+        _log_queue.close()
+        _log_queue.join_thread()
+        _file_listener = _log_queue = None
+
+atexit.register(_stop_file_listener)
+
+def get_log_queue():
+    """
+    Очередь записей файла лога этого процесса - для передачи процессам-воркерам
+    (setup_logging(config, log_queue=...)): все процессы пишут в один файл через
+    один обработчик. None, если логирование в файл не настроено.
+    """
+    return _log_queue
+
+def setup_logging(config, log_queue=None):
+    """
+    Настраивает систему логирования на основе конфигурации с кастомными цветами для консоли.
+
+    Args:
+        config (dict): Общий словарь конфигурации (секция 'logging').
+        log_queue (multiprocessing.Queue | None): Для процессов-воркеров - очередь из get_log_queue()
+                  главного процесса: записи для файла отправляются туда, сам файл не открывается.
+    """
 
     log_config = config.get('logging', {})
     log_level_str = log_config.get('level', 'INFO').upper()
@@ -75,12 +140,13 @@ def setup_logging(config):
 
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+    _stop_file_listener() # Повторная настройка: старый файловый обработчик больше не нужен
 
     log_format = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
     date_format = '%Y-%m-%d %H:%M:%S'
 
-    # Стандартный форматтер для файла (БЕЗ ЦВЕТОВ)
-    standard_formatter = logging.Formatter(log_format, datefmt=date_format)
+    # Стандартный форматтер для файла (БЕЗ ЦВЕТОВ, но с тем же кэшем времени)
+    standard_formatter = ColoredFormatter(log_format, datefmt=date_format, use_colors=False)
 
     # Проверяем поддержку цветов терминалом
     supports_color = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
@@ -97,7 +163,12 @@ def setup_logging(config):
         logger.addHandler(console_handler)
 
     # Файловый обработчик
-    if log_file:
+    if log_queue is not None:
+        # Процесс-воркер: файл пишет главный процесс, сюда - только очередь
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setLevel(log_level)
+        logger.addHandler(queue_handler)
+    elif log_file:
         try:
             log_dir = os.path.dirname(log_file)
             if log_dir and not os.path.exists(log_dir):
@@ -108,7 +179,15 @@ def setup_logging(config):
             )
             file_handler.setLevel(log_level)
             file_handler.setFormatter(standard_formatter) # <- Стандартный форматтер для файла
-            logger.addHandler(file_handler)
+            # Запись в файл - в отдельном потоке: logger.info() только кладет запись в очередь
+            # и не ждет диска (и блокировки файлового обработчика)
+            global _file_listener, _log_queue
+            _log_queue = multiprocessing.get_context('spawn').Queue()
+            queue_handler = QueueHandler(_log_queue)
+            queue_handler.setLevel(log_level)
+            _file_listener = QueueListener(_log_queue, file_handler, respect_handler_level=True)
+            _file_listener.start()
+            logger.addHandler(queue_handler)
         except Exception as e:
             logging.error(f"Не удалось настроить файловый логгер для '{log_file}': {e}", exc_info=True)
 